@@ -0,0 +1,83 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from storage import find_rows, append_rows, locked, next_ids
+from counters import allocations_added
+import waitlist
+
+def calc_priority(worker):
+    score = 0
+    if worker['disability_status'] == 'Yes':
+        score += 100
+    if worker['days_worked'] < 50:
+        score += 50
+    score += (100 - min(worker['days_worked'], 100))
+    return score
+
+def priority_scores(workers):
+    # Same score as calc_priority, computed for the whole frame at once
+    days = workers['days_worked'].to_numpy()
+    return (np.where(workers['disability_status'].to_numpy() == 'Yes', 100, 0)
+            + np.where(days < 50, 50, 0)
+            + (100 - np.minimum(days, 100))).astype('int64')
+
+def rank_workers(workers):
+    # Highest score first, earlier registrations first among equal scores. Scores are small
+    # bounded integers, so the stable argsort runs as a linear-time radix sort
+    scores = priority_scores(workers)
+    order = np.argsort(-scores.astype(np.int16), kind='stable')
+    ranked = workers.iloc[order].copy()
+    ranked['priority_score'] = scores[order]
+    return ranked
+
+def allocate_jobs(job_ids, progress=None):
+    # Allocates several jobs with one read of the workers involved and one bulk write.
+    # Workers who already have a row for a job keep it and only the missing rows are added,
+    # so running it again after an interrupted run finishes the job instead of duplicating it
+    job_ids = list(job_ids)
+    with locked('allocations', job_id=job_ids):
+        jobs = find_rows('jobs', job_id=job_ids)
+        if jobs.empty:
+            return 0
+        if progress:
+            progress(0, len(jobs))
+        workers = find_rows('users', role='worker', district=list(jobs['district'].unique()))
+        ranked = {district: rank_workers(group)
+                  for district, group in workers.groupby('district', sort=False, observed=True)}
+        existing = find_rows('allocations', job_id=list(jobs['job_id']))
+        existing = dict(list(existing.groupby('job_id', sort=False, observed=True)))
+        batches = []
+        for job in jobs.to_dict('records'):
+            district_workers = ranked.get(job['district'])
+            if district_workers is None or district_workers.empty:
+                continue
+            required = int(job['workers_required'])
+            done = existing.get(job['job_id'])
+            if done is not None:
+                district_workers = district_workers[~district_workers['user_id'].isin(done['worker_id'])]
+                required -= int((done['allocation_status'] == 'Allocated').sum())
+            if district_workers.empty:
+                continue
+            status = np.where(np.arange(len(district_workers)) < required, 'Allocated', 'Waiting')
+            batches.append(pd.DataFrame({
+                'job_id': job['job_id'],
+                'worker_id': district_workers['user_id'].to_numpy(),
+                'allocation_status': status,
+                'response': 'Pending',
+                'priority_score': district_workers['priority_score'].to_numpy(),
+            }))
+        if not batches:
+            return 0
+        allocs = pd.concat(batches, ignore_index=True)
+        ids = pd.Series(next_ids('allocations', len(allocs)))
+        allocs.insert(0, 'allocation_id', 'ALLOC' + ids.astype(str).str.zfill(5))
+        allocs['allocated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        append_rows('allocations', allocs)
+        allocations_added(allocs)
+        waitlist.invalidate(allocs['job_id'].unique())
+        if progress:
+            progress(len(jobs), len(jobs))
+        return len(allocs)
+
+def allocate_workers(job_id):
+    return allocate_jobs([job_id])
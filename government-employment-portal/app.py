@@ -1,30 +1,59 @@
-from flask import Flask, render_template, request, redirect, session, flash
+from flask import Flask, render_template, request, redirect, session, flash, url_for, abort, Response, jsonify
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import os
 import random
 import hashlib
+from storage import (SCHEMAS, configure, find_rows, count_rows, query_rows, iter_csv, append_rows,
+                     update_rows, locked, named_lock, next_id, init_tables, concat_rows, join_rows, format_rows, first_row,
+                     is_closed)
+from attendance import allocated_workers, mark_crew
+import counters
+import otp_store
+import metrics
+import tasks
+import waitlist
+import page_cache
 
 app = Flask(__name__)
 app.secret_key = 'government-employment-portal-secret-2025'
-
-# Ensure data directory exists
-os.makedirs('data', exist_ok=True)
-
-# Initialize CSV files
+# 'csv' keeps the tables in data/*.csv; 'sqlite' uses data/portal.db (see sqlite_store.py);
+# 'sharded' splits them by district under data/shards/ (see shards.py)
+app.config['STORAGE_BACKEND'] = os.environ.get('PORTAL_STORAGE_BACKEND', 'csv')
+# Processes that state-wide work runs the district shards on (default: one per CPU)
+app.config['SHARD_WORKERS'] = int(os.environ.get('PORTAL_SHARD_WORKERS', os.cpu_count() or 1))
+# 'month' or 'year' keeps attendance in one file per period (csv and sharded; see partitions.py)
+app.config['ATTENDANCE_PARTITIONS'] = os.environ.get('PORTAL_ATTENDANCE_PARTITIONS') or None
+# Dashboard counters are built once from the tables; set to 1 to rebuild them on startup
+app.config['REBUILD_COUNTERS'] = os.environ.get('PORTAL_REBUILD_COUNTERS') == '1'
+# 'memory' keeps OTPs in this process; use 'sqlite' (data/.meta/otp.db) with several worker processes
+app.config['OTP_BACKEND'] = os.environ.get('PORTAL_OTP_BACKEND', 'memory')
+# Requests slower than this are logged with their storage/render breakdown (to SLOW_LOG if set)
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('PORTAL_SLOW_REQUEST_MS', 500))
+app.config['SLOW_LOG'] = os.environ.get('PORTAL_SLOW_LOG', '')
+# Fraction of requests run under cProfile, written to PROFILE_DIR as .prof files
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PORTAL_PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PORTAL_PROFILE_DIR', 'data/.meta/profiles')
+# Threads running allocation and payroll tasks in the background; 0 runs them inside the request
+app.config['TASK_WORKERS'] = int(os.environ.get('PORTAL_TASK_WORKERS', 2))
+# Memory for rendered pages of the read-heavy routes, per process; 0 turns the page cache off
+app.config['PAGE_CACHE_MB'] = float(os.environ.get('PORTAL_PAGE_CACHE_MB', 64))
+metrics.init_app(app)
+
+# Initialize data files
 def init_data():
-    if not os.path.exists('data/users.csv'):
-        pd.DataFrame(columns=['user_id', 'name', 'email', 'phone', 'password', 'role', 'district', 'aadhaar', 'disability_status', 'days_worked', 'created_at']).to_csv('data/users.csv', index=False)
-    if not os.path.exists('data/jobs.csv'):
-        pd.DataFrame(columns=['job_id', 'district', 'work_type', 'start_date', 'duration', 'workers_required', 'daily_wage', 'status', 'created_by', 'created_at']).to_csv('data/jobs.csv', index=False)
-    if not os.path.exists('data/allocations.csv'):
-        pd.DataFrame(columns=['allocation_id', 'job_id', 'worker_id', 'allocation_status', 'response', 'priority_score', 'allocated_at']).to_csv('data/allocations.csv', index=False)
-    if not os.path.exists('data/attendance.csv'):
-        pd.DataFrame(columns=['attendance_id', 'job_id', 'worker_id', 'supervisor_id', 'date', 'status', 'marked_at']).to_csv('data/attendance.csv', index=False)
-    if not os.path.exists('data/wages.csv'):
-        pd.DataFrame(columns=['wage_id', 'worker_id', 'job_id', 'days_present', 'daily_wage', 'total_wage', 'payment_status', 'calculated_at']).to_csv('data/wages.csv', index=False)
-    if not os.path.exists('data/otp.csv'):
-        pd.DataFrame(columns=['phone', 'otp', 'created_at', 'used']).to_csv('data/otp.csv', index=False)
+    options = {}
+    if app.config['STORAGE_BACKEND'] == 'sharded':
+        options['workers'] = app.config['SHARD_WORKERS']
+    if app.config['STORAGE_BACKEND'] != 'sqlite':
+        options['partitions'] = app.config['ATTENDANCE_PARTITIONS']
+    configure(app.config['STORAGE_BACKEND'], **options)
+    init_tables()
+    counters.ensure_counters(force=app.config['REBUILD_COUNTERS'])
+    otp_store.configure(app.config['OTP_BACKEND'])
+    tasks.configure(app.config['TASK_WORKERS'])
+    tasks.recover()
+    page_cache.configure(app.config['PAGE_CACHE_MB'])
 
 init_data()
 
@@ -41,74 +70,83 @@ def send_otp(phone, otp):
     return True
 
 def verify_otp(phone, otp):
-    try:
-        otp_df = pd.read_csv('data/otp.csv')
-        valid = otp_df[(otp_df['phone'] == phone) & (otp_df['otp'] == otp) & (otp_df['used'] == False)]
-        if not valid.empty:
-            latest = valid.iloc[-1]
-            created = datetime.strptime(latest['created_at'], '%Y-%m-%d %H:%M:%S')
-            if datetime.now() - created < timedelta(minutes=10):
-                otp_df.loc[otp_df.index == latest.name, 'used'] = True
-                otp_df.to_csv('data/otp.csv', index=False)
-                return True
-    except:
-        pass
-    return False
-
-def calc_priority(worker):
-    score = 0
-    if worker['disability_status'] == 'Yes':
-        score += 100
-    if worker['days_worked'] < 50:
-        score += 50
-    score += (100 - min(worker['days_worked'], 100))
-    return score
-
-def allocate_workers(job_id):
-    users = pd.read_csv('data/users.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    allocations = pd.read_csv('data/allocations.csv')
-    
-    job = jobs[jobs['job_id'] == job_id].iloc[0]
-    workers = users[(users['role'] == 'worker') & (users['district'] == job['district'])].copy()
-    
-    if workers.empty:
-        return
-    
-    workers['priority_score'] = workers.apply(calc_priority, axis=1)
-    workers = workers.sort_values('priority_score', ascending=False)
-    
-    required = int(job['workers_required'])
-    selected = workers.head(required)
-    waiting = workers.iloc[required:]
-    
-    for _, w in selected.iterrows():
-        alloc_id = f"ALLOC{str(len(allocations) + 1).zfill(5)}"
-        new_alloc = {
-            'allocation_id': alloc_id,
-            'job_id': job_id,
-            'worker_id': w['user_id'],
-            'allocation_status': 'Allocated',
-            'response': 'Pending',
-            'priority_score': w['priority_score'],
-            'allocated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        allocations = pd.concat([allocations, pd.DataFrame([new_alloc])], ignore_index=True)
-    
-    for _, w in waiting.iterrows():
-        alloc_id = f"ALLOC{str(len(allocations) + 1).zfill(5)}"
-        new_alloc = {
-            'allocation_id': alloc_id,
-            'job_id': job_id,
-            'worker_id': w['user_id'],
-            'allocation_status': 'Waiting',
-            'response': 'Pending',
-            'priority_score': w['priority_score'],
-            'allocated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        allocations = pd.concat([allocations, pd.DataFrame([new_alloc])], ignore_index=True)
-    
-    allocations.to_csv('data/allocations.csv', index=False)
+    return otp_store.check_otp(phone, otp)
+
+# ========== LISTINGS ==========
+# List pages take ?page=, ?per_page=, ?sort=, ?order=asc|desc and the filters below; the storage
+# backend does the filtering, sorting and slicing so only one page is loaded
+PER_PAGE = 50
+MAX_PER_PAGE = 500
+# Column holding each table's status filter
+STATUS_COLUMNS = {'jobs': 'status', 'allocations': 'allocation_status', 'attendance': 'status',
+                  'wages': 'payment_status'}
+EXPORT_TABLES = list(STATUS_COLUMNS)
+
+class Page:
+    def __init__(self, rows, total, number, per_page, sort, descending):
+        self.rows = rows
+        self.total = total
+        self.number = number
+        self.per_page = per_page
+        self.pages = max((total + per_page - 1) // per_page, 1)
+        self.sort = sort
+        self.descending = descending
+
+    def url(self, **changes):
+        # Path parameters win over query parameters of the same name
+        args = {**request.args.to_dict(), **changes, **request.view_args}
+        return url_for(request.endpoint, **args)
+
+    def sort_url(self, column):
+        order = 'desc' if self.sort == column and not self.descending else 'asc'
+        return self.url(sort=column, order=order, page=1)
+
+def list_filters(name):
+    # district, job_id, status, date_from and date_to from the query string as storage conditions
+    args = request.args
+    where = {}
+    if args.get('job_id'):
+        where['job_id'] = args['job_id']
+    if args.get('status'):
+        where[STATUS_COLUMNS[name]] = args['status']
+    if name == 'attendance':
+        if args.get('date_from'):
+            where['date__ge'] = args['date_from']
+        if args.get('date_to'):
+            where['date__le'] = args['date_to']
+    if args.get('district'):
+        if name == 'jobs':
+            where['district'] = args['district']
+        else:
+            job_ids = find_rows('jobs', district=args['district'])['job_id']
+            if 'job_id' in where:
+                job_ids = job_ids[job_ids == where['job_id']]
+            where['job_id'] = list(job_ids)
+    return where
+
+def list_page(name, where, sort_columns, default_sort=None, default_descending=False):
+    number = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    sort = request.args.get('sort', default_sort)
+    if sort not in sort_columns:
+        sort = default_sort
+    order = request.args.get('order')
+    descending = order == 'desc' if order in ('asc', 'desc') else default_descending
+    rows, total = query_rows(name, order_by=sort, descending=descending, limit=per_page,
+                             offset=(number - 1) * per_page, **where)
+    return Page(rows, total, number, per_page, sort, descending)
+
+def with_names(df):
+    # Adds worker names, looking up only the workers on this page
+    users = find_rows('users', user_id=df['worker_id'].unique())
+    return join_rows(df, users[['user_id', 'name']], 'worker_id', 'user_id')
+
+def records(df):
+    # Rows for a template as dicts of plain values, with dates shown as in the CSV files.
+    # Built column by column; to_dict boxes categorical values one at a time
+    df = format_rows(df)
+    columns = [df[col].to_numpy().tolist() for col in df.columns]
+    return [dict(zip(df.columns, row)) for row in zip(*columns)]
 
 # ========== HOME & AUTH ==========
 @app.route('/')
@@ -119,7 +157,6 @@ def index():
 def signup():
     if request.method == 'POST':
         try:
-            users = pd.read_csv('data/users.csv')
             name = request.form['name']
             email = request.form['email']
             phone = request.form['phone']
@@ -129,26 +166,29 @@ def signup():
             aadhaar = request.form.get('aadhaar', '')
             disability = request.form.get('disability_status', 'No')
             
-            if not users[(users['email'] == email) | (users['phone'] == phone)].empty:
-                flash('User already exists!', 'error')
-                return redirect('/signup')
+            # Email and phone are unique across all districts: signups are serialized by a lock of
+            # their own, and only the new user's district of users is locked
+            with named_lock('signup'), locked('users', district=district):
+                if count_rows('users', email=email) or count_rows('users', phone=phone):
+                    flash('User already exists!', 'error')
+                    return redirect('/signup')
             
-            user_id = f"{role[:3].upper()}{str(len(users) + 1).zfill(4)}"
-            new_user = {
-                'user_id': user_id,
-                'name': name,
-                'email': email,
-                'phone': phone,
-                'password': password,
-                'role': role,
-                'district': district,
-                'aadhaar': aadhaar,
-                'disability_status': disability,
-                'days_worked': 0,
-                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-            users = pd.concat([users, pd.DataFrame([new_user])], ignore_index=True)
-            users.to_csv('data/users.csv', index=False)
+                user_id = f"{role[:3].upper()}{str(next_id('users')).zfill(4)}"
+                new_user = {
+                    'user_id': user_id,
+                    'name': name,
+                    'email': email,
+                    'phone': phone,
+                    'password': password,
+                    'role': role,
+                    'district': district,
+                    'aadhaar': aadhaar,
+                    'disability_status': disability,
+                    'days_worked': 0,
+                    'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+                append_rows('users', [new_user])
+                counters.user_added(new_user)
             flash('Signup successful! Please login.', 'success')
             return redirect('/login')
         except Exception as e:
@@ -160,12 +200,11 @@ def login():
     if request.method == 'POST':
         try:
             session.clear()
-            users = pd.read_csv('data/users.csv')
             email = request.form['email']
             password = hash_password(request.form['password'])
-            user = users[(users['email'] == email) & (users['password'] == password)]
+            user = find_rows('users', email=email, password=password)
             if not user.empty:
-                u = user.iloc[0]
+                u = first_row(user)
                 session['user_id'] = str(u['user_id'])
                 session['name'] = str(u['name'])
                 session['role'] = str(u['role'])
@@ -192,17 +231,7 @@ def logout():
 def gov_dashboard():
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    users = pd.read_csv('data/users.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    allocations = pd.read_csv('data/allocations.csv')
-    wages = pd.read_csv('data/wages.csv')
-    stats = {
-        'total_workers': len(users[users['role'] == 'worker']),
-        'active_jobs': len(jobs[jobs['status'] == 'active']),
-        'workers_allocated': len(allocations[allocations['allocation_status'] == 'Allocated']),
-        'wages_paid': wages['total_wage'].sum() if not wages.empty else 0,
-        'disabled_workers': len(users[(users['role'] == 'worker') & (users['disability_status'] == 'Yes')])
-    }
+    stats = counters.government_stats()
     return render_template('government_dashboard.html', stats=stats)
 
 @app.route('/government/create-job', methods=['GET', 'POST'])
@@ -211,8 +240,7 @@ def create_job():
         return redirect('/login')
     if request.method == 'POST':
         try:
-            jobs = pd.read_csv('data/jobs.csv')
-            job_id = f"JOB{str(len(jobs) + 1).zfill(4)}"
+            job_id = f"JOB{str(next_id('jobs')).zfill(4)}"
             new_job = {
                 'job_id': job_id,
                 'district': request.form['district'],
@@ -225,134 +253,151 @@ def create_job():
                 'created_by': session['user_id'],
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
-            jobs = pd.concat([jobs, pd.DataFrame([new_job])], ignore_index=True)
-            jobs.to_csv('data/jobs.csv', index=False)
-            allocate_workers(job_id)
-            flash('Job created successfully!', 'success')
+            append_rows('jobs', [new_job])
+            counters.job_added(new_job)
+            task_id = tasks.enqueue('allocate', session['user_id'], job_ids=[job_id])
+            flash(f'Job created successfully! Workers are being allocated ({task_id}).', 'success')
             return redirect('/government/jobs')
         except Exception as e:
             flash(f'Error: {str(e)}', 'error')
     return render_template('create_job.html')
 
 @app.route('/government/jobs')
+@page_cache.cached('jobs')
 def gov_jobs():
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    jobs = pd.read_csv('data/jobs.csv')
-    return render_template('government_jobs.html', jobs=jobs.to_dict('records'))
+    page = list_page('jobs', list_filters('jobs'),
+                     ['job_id', 'district', 'work_type', 'start_date', 'workers_required', 'daily_wage'])
+    page.rows = records(page.rows)
+    return render_template('government_jobs.html', page=page)
 
 @app.route('/government/allocations/<job_id>')
+@page_cache.cached('jobs', 'allocations', 'users')
 def view_allocations(job_id):
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    allocations = pd.read_csv('data/allocations.csv')
-    users = pd.read_csv('data/users.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    job = jobs[jobs['job_id'] == job_id].iloc[0] if not jobs[jobs['job_id'] == job_id].empty else None
-    allocs = allocations[allocations['job_id'] == job_id]
-    allocs = allocs.merge(users[['user_id', 'name', 'phone', 'disability_status', 'days_worked']], 
-                          left_on='worker_id', right_on='user_id', how='left')
-    allocated = allocs[allocs['allocation_status'] == 'Allocated'].to_dict('records')
-    waiting = allocs[allocs['allocation_status'] == 'Waiting'].to_dict('records')
-    return render_template('view_allocations.html', job=job, allocated=allocated, waiting=waiting)
+    jobs = find_rows('jobs', job_id=job_id)
+    job = first_row(jobs) if not jobs.empty else None
+    allocated = find_rows('allocations', job_id=job_id, allocation_status='Allocated')
+    # The waiting list can hold a whole district, so it is paged
+    page = list_page('allocations', {'job_id': job_id, 'allocation_status': 'Waiting'},
+                     ['priority_score', 'worker_id'], 'priority_score', True)
+    allocs = concat_rows([allocated, page.rows], SCHEMAS['allocations'])
+    users = find_rows('users', user_id=allocs['worker_id'].unique())
+    allocs = join_rows(allocs, users[['user_id', 'name', 'phone', 'disability_status', 'days_worked']],
+                       'worker_id', 'user_id')
+    page.rows = records(allocs.iloc[len(allocated):])
+    return render_template('view_allocations.html', job=job, allocated=records(allocs.iloc[:len(allocated)]),
+                           waiting=page)
 
 @app.route('/government/attendance')
 def gov_attendance():
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    attendance = pd.read_csv('data/attendance.csv')
-    users = pd.read_csv('data/users.csv')
-    attendance = attendance.merge(users[['user_id', 'name']], left_on='worker_id', right_on='user_id', how='left')
-    return render_template('government_attendance.html', attendance=attendance.to_dict('records'))
+    page = list_page('attendance', list_filters('attendance'), ['date', 'job_id', 'worker_id', 'status'])
+    page.rows = records(with_names(page.rows))
+    return render_template('government_attendance.html', page=page)
 
 @app.route('/government/wages')
 def gov_wages():
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    wages = pd.read_csv('data/wages.csv')
-    users = pd.read_csv('data/users.csv')
-    wages = wages.merge(users[['user_id', 'name']], left_on='worker_id', right_on='user_id', how='left')
-    return render_template('government_wages.html', wages=wages.to_dict('records'))
+    page = list_page('wages', list_filters('wages'),
+                     ['worker_id', 'job_id', 'days_present', 'total_wage', 'payment_status'])
+    page.rows = records(with_names(page.rows))
+    return render_template('government_wages.html', page=page)
+
+@app.route('/government/export/<table>.csv')
+def export_csv(table):
+    # Streams the whole filtered table chunk by chunk, for datasets too large to page through
+    if 'user_id' not in session or session['role'] != 'government':
+        return redirect('/login')
+    if table not in EXPORT_TABLES:
+        abort(404)
+    where = list_filters(table)
+    
+    def generate():
+        yield ','.join(SCHEMAS[table]) + '\n'
+        yield from iter_csv(table, **where)
+    
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={table}.csv'})
 
 @app.route('/government/calculate-wages')
 def calculate_wages():
     if 'user_id' not in session or session['role'] != 'government':
         return redirect('/login')
-    attendance = pd.read_csv('data/attendance.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    wages = pd.read_csv('data/wages.csv')
-    if not attendance.empty:
-        grouped = attendance[attendance['status'] == 'Present'].groupby(['worker_id', 'job_id']).size().reset_index(name='days_present')
-        for _, row in grouped.iterrows():
-            job = jobs[jobs['job_id'] == row['job_id']]
-            if not job.empty:
-                daily_wage = job.iloc[0]['daily_wage']
-                total = row['days_present'] * daily_wage
-                wage_id = f"WAGE{str(len(wages) + 1).zfill(5)}"
-                new_wage = {
-                    'wage_id': wage_id,
-                    'worker_id': row['worker_id'],
-                    'job_id': row['job_id'],
-                    'days_present': row['days_present'],
-                    'daily_wage': daily_wage,
-                    'total_wage': total,
-                    'payment_status': 'Pending',
-                    'calculated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-                wages = pd.concat([wages, pd.DataFrame([new_wage])], ignore_index=True)
-        wages.to_csv('data/wages.csv', index=False)
-        flash('Wages calculated!', 'success')
-    else:
-        flash('No attendance data!', 'warning')
-    return redirect('/government/wages')
+    task_id = tasks.enqueue('payroll', session['user_id'])
+    flash(f'Wage calculation started ({task_id})!', 'info')
+    return redirect('/government/tasks')
+
+@app.route('/government/tasks')
+def gov_tasks():
+    if 'user_id' not in session or session['role'] != 'government':
+        return redirect('/login')
+    page = list_page('tasks', {}, ['task_id', 'kind', 'status', 'created_at'], 'task_id', True)
+    page.rows = records(page.rows)
+    return render_template('government_tasks.html', page=page)
+
+@app.route('/government/tasks/<task_id>')
+def task_status(task_id):
+    # Polled by the tasks page while a task is queued or running
+    if 'user_id' not in session or session['role'] != 'government':
+        abort(403)
+    task = find_rows('tasks', task_id=task_id)
+    if task.empty:
+        abort(404)
+    return jsonify(records(task)[0])
 
 # ========== WORKER ==========
 @app.route('/worker/dashboard')
 def worker_dashboard():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    users = pd.read_csv('data/users.csv')
-    allocations = pd.read_csv('data/allocations.csv')
-    attendance = pd.read_csv('data/attendance.csv')
-    wages = pd.read_csv('data/wages.csv')
-    worker = users[users['user_id'] == session['user_id']].iloc[0]
-    stats = {
-        'total_days_worked': int(worker['days_worked']),
-        'active_jobs': len(allocations[(allocations['worker_id'] == session['user_id']) & (allocations['allocation_status'] == 'Allocated')]),
-        'days_present': len(attendance[(attendance['worker_id'] == session['user_id']) & (attendance['status'] == 'Present')]),
-        'total_earnings': wages[wages['worker_id'] == session['user_id']]['total_wage'].sum() if not wages.empty else 0
-    }
+    worker = first_row(find_rows('users', user_id=session['user_id']))
+    stats = {'total_days_worked': int(worker['days_worked']), **counters.worker_stats(session['user_id'])}
     return render_template('worker_dashboard.html', worker=worker, stats=stats)
 
 @app.route('/worker/profile')
 def worker_profile():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    users = pd.read_csv('data/users.csv')
-    worker = users[users['user_id'] == session['user_id']].iloc[0].to_dict()
+    worker = first_row(find_rows('users', user_id=session['user_id']))
     aadhaar = worker['aadhaar']
     worker['masked_aadhaar'] = 'XXXX-XXXX-' + str(aadhaar)[-4:] if aadhaar else 'Not Provided'
     return render_template('worker_profile.html', worker=worker)
 
 @app.route('/worker/jobs')
+@page_cache.cached('allocations', 'jobs')
 def worker_jobs():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    allocations = pd.read_csv('data/allocations.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    allocs = allocations[allocations['worker_id'] == session['user_id']]
-    allocs = allocs.merge(jobs, on='job_id', how='left')
-    return render_template('worker_jobs.html', jobs=allocs.to_dict('records'))
+    allocs = find_rows('allocations', worker_id=session['user_id'])
+    jobs = find_rows('jobs', job_id=allocs['job_id'])
+    allocs = join_rows(allocs, jobs, 'job_id')
+    return render_template('worker_jobs.html', jobs=records(allocs))
 
 @app.route('/worker/respond-job', methods=['POST'])
 def respond_job():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    allocations = pd.read_csv('data/allocations.csv')
     alloc_id = request.form['allocation_id']
     response = request.form['response']
-    allocations.loc[allocations['allocation_id'] == alloc_id, 'response'] = response
-    allocations.to_csv('data/allocations.csv', index=False)
+    # Only the worker's own allocations; any other is treated as not found
+    alloc = find_rows('allocations', allocation_id=alloc_id, worker_id=session['user_id'])
+    if alloc.empty:
+        flash('Allocation not found!', 'error')
+        return redirect('/worker/jobs')
+    with locked('allocations', job_id=first_row(alloc)['job_id']):
+        # Read again under the lock of the job's allocations
+        alloc = find_rows('allocations', allocation_id=alloc_id, worker_id=session['user_id'])
+        row = dict(first_row(alloc), response=response)
+        if response in waitlist.REJECTIONS:
+            # Frees the worker's slot for the next worker on the job's waiting list
+            waitlist.release(row)
+        else:
+            update_rows('allocations', [row])
     flash(f'Job {response.lower()} successfully!', 'success')
     return redirect('/worker/jobs')
 
@@ -360,45 +405,36 @@ def respond_job():
 def worker_attendance():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    attendance = pd.read_csv('data/attendance.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    att = attendance[attendance['worker_id'] == session['user_id']]
-    att = att.merge(jobs[['job_id', 'work_type']], on='job_id', how='left')
-    return render_template('worker_attendance.html', attendance=att.to_dict('records'))
+    att = find_rows('attendance', worker_id=session['user_id'])
+    jobs = find_rows('jobs', job_id=att['job_id'])
+    att = join_rows(att, jobs[['job_id', 'work_type']], 'job_id')
+    return render_template('worker_attendance.html', attendance=records(att))
 
 @app.route('/worker/wages')
+@page_cache.cached('wages', 'jobs')
 def worker_wages():
     if 'user_id' not in session or session['role'] != 'worker':
         return redirect('/login')
-    wages = pd.read_csv('data/wages.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    w = wages[wages['worker_id'] == session['user_id']]
-    w = w.merge(jobs[['job_id', 'work_type']], on='job_id', how='left')
-    return render_template('worker_wages.html', wages=w.to_dict('records'))
+    w = find_rows('wages', worker_id=session['user_id'])
+    jobs = find_rows('jobs', job_id=w['job_id'])
+    w = join_rows(w, jobs[['job_id', 'work_type']], 'job_id')
+    return render_template('worker_wages.html', wages=records(w))
 
 # ========== SUPERVISOR ==========
 @app.route('/supervisor/dashboard')
 def sup_dashboard():
     if 'user_id' not in session or session['role'] != 'supervisor':
         return redirect('/login')
-    jobs = pd.read_csv('data/jobs.csv')
-    attendance = pd.read_csv('data/attendance.csv')
-    stats = {
-        'total_jobs': len(jobs),
-        'today_attendance': len(attendance[(attendance['supervisor_id'] == session['user_id']) & (attendance['date'] == datetime.today().strftime('%Y-%m-%d'))]),
-        'total_marked': len(attendance[attendance['supervisor_id'] == session['user_id']])
-    }
+    stats = counters.supervisor_stats(session['user_id'], datetime.today().strftime('%Y-%m-%d'))
     return render_template('supervisor_dashboard.html', stats=stats)
 
 @app.route('/supervisor/jobs')
 def sup_jobs():
     if 'user_id' not in session or session['role'] != 'supervisor':
         return redirect('/login')
-    jobs = pd.read_csv('data/jobs.csv')
-    users = pd.read_csv('data/users.csv')
-    sup = users[users['user_id'] == session['user_id']].iloc[0]
-    district_jobs = jobs[jobs['district'] == sup['district']]
-    return render_template('supervisor_jobs.html', jobs=district_jobs.to_dict('records'))
+    sup = first_row(find_rows('users', user_id=session['user_id']))
+    district_jobs = find_rows('jobs', district=sup['district'])
+    return render_template('supervisor_jobs.html', jobs=records(district_jobs))
 
 @app.route('/supervisor/mark-attendance/<job_id>', methods=['GET', 'POST'])
 def mark_attendance(job_id):
@@ -409,69 +445,102 @@ def mark_attendance(job_id):
         otp = request.form.get('otp')
         if not otp:
             otp_code = generate_otp()
-            otp_df = pd.read_csv('data/otp.csv')
-            new_otp = {
-                'phone': phone,
-                'otp': otp_code,
-                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'used': False
-            }
-            otp_df = pd.concat([otp_df, pd.DataFrame([new_otp])], ignore_index=True)
-            otp_df.to_csv('data/otp.csv', index=False)
+            otp_store.issue_otp(phone, otp_code)
             send_otp(phone, otp_code)
             flash(f'OTP sent! Check console for demo OTP', 'info')
             return render_template('mark_attendance.html', job_id=job_id, phone=phone, otp_sent=True)
         else:
             if verify_otp(phone, otp):
-                users = pd.read_csv('data/users.csv')
-                attendance = pd.read_csv('data/attendance.csv')
-                worker = users[users['phone'] == phone]
-                if not worker.empty:
-                    w = worker.iloc[0]
-                    today = datetime.today().strftime('%Y-%m-%d')
-                    exists = attendance[(attendance['worker_id'] == w['user_id']) & (attendance['job_id'] == job_id) & (attendance['date'] == today)]
-                    if not exists.empty:
-                        flash('Already marked today!', 'warning')
+                with locked('attendance', 'users', job_id=job_id, phone=phone):
+                    worker = find_rows('users', phone=phone)
+                    if not worker.empty:
+                        w = first_row(worker)
+                        today = datetime.today().strftime('%Y-%m-%d')
+                        if count_rows('attendance', worker_id=w['user_id'], job_id=job_id, date=today):
+                            flash('Already marked today!', 'warning')
+                        else:
+                            att_id = f"ATT{str(next_id('attendance')).zfill(5)}"
+                            new_att = {
+                                'attendance_id': att_id,
+                                'job_id': job_id,
+                                'worker_id': w['user_id'],
+                                'supervisor_id': session['user_id'],
+                                'date': today,
+                                'status': 'Present',
+                                'marked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                            }
+                            append_rows('attendance', [new_att])
+                            counters.attendance_added(pd.DataFrame([new_att]))
+                            update_rows('users', [dict(w, days_worked=w['days_worked'] + 1)])
+                            flash(f'Attendance marked for {w["name"]}!', 'success')
                     else:
-                        att_id = f"ATT{str(len(attendance) + 1).zfill(5)}"
-                        new_att = {
-                            'attendance_id': att_id,
-                            'job_id': job_id,
-                            'worker_id': w['user_id'],
-                            'supervisor_id': session['user_id'],
-                            'date': today,
-                            'status': 'Present',
-                            'marked_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
-                        attendance = pd.concat([attendance, pd.DataFrame([new_att])], ignore_index=True)
-                        attendance.to_csv('data/attendance.csv', index=False)
-                        users.loc[users['user_id'] == w['user_id'], 'days_worked'] = w['days_worked'] + 1
-                        users.to_csv('data/users.csv', index=False)
-                        flash(f'Attendance marked for {w["name"]}!', 'success')
-                else:
-                    flash('Worker not found!', 'error')
+                        flash('Worker not found!', 'error')
             else:
                 flash('Invalid OTP!', 'error')
             return redirect(f'/supervisor/mark-attendance/{job_id}')
-    jobs = pd.read_csv('data/jobs.csv')
-    allocations = pd.read_csv('data/allocations.csv')
-    users = pd.read_csv('data/users.csv')
-    job = jobs[jobs['job_id'] == job_id].iloc[0] if not jobs[jobs['job_id'] == job_id].empty else None
-    workers = allocations[(allocations['job_id'] == job_id) & (allocations['allocation_status'] == 'Allocated')]
-    workers = workers.merge(users[['user_id', 'name', 'phone', 'aadhaar']], left_on='worker_id', right_on='user_id', how='left')
-    return render_template('mark_attendance.html', job=job, workers=workers.to_dict('records'), job_id=job_id)
+    jobs = find_rows('jobs', job_id=job_id)
+    job = first_row(jobs) if not jobs.empty else None
+    workers = find_rows('allocations', job_id=job_id, allocation_status='Allocated')
+    users = find_rows('users', user_id=workers['worker_id'])
+    workers = join_rows(workers, users[['user_id', 'name', 'phone', 'aadhaar']], 'worker_id', 'user_id')
+    return render_template('mark_attendance.html', job=job, workers=records(workers), job_id=job_id)
+
+@app.route('/supervisor/mark-attendance/<job_id>/crew', methods=['POST'])
+def mark_crew_attendance(job_id):
+    if 'user_id' not in session or session['role'] != 'supervisor':
+        return redirect('/login')
+    # One worker per line: "phone" to send an OTP, "phone otp" to verify it and mark Present
+    entries = [line.replace(',', ' ').split() for line in request.form.get('entries', '').splitlines()]
+    entries = [entry for entry in entries if entry]
+    today = datetime.today().strftime('%Y-%m-%d')
+    date = request.form.get('date') or today
+    try:
+        if datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d') > today:
+            raise ValueError
+    except ValueError:
+        flash('Invalid attendance date!', 'error')
+        return redirect(f'/supervisor/mark-attendance/{job_id}')
+    if is_closed('attendance', date):
+        flash('Attendance for that date is closed!', 'error')
+        return redirect(f'/supervisor/mark-attendance/{job_id}')
+    
+    if request.form.get('action') == 'send':
+        phones = [entry[0] for entry in entries]
+        workers = allocated_workers(job_id, phone=phones)
+        for phone in workers['phone'].unique():
+            otp_code = generate_otp()
+            otp_store.issue_otp(phone, otp_code)
+            send_otp(phone, otp_code)
+        flash(f'OTP sent to {workers["phone"].nunique()} workers! Check console for demo OTPs', 'info')
+        unknown = set(phones) - set(workers['phone'])
+        if unknown:
+            flash(f'Not allocated to this job: {", ".join(sorted(unknown))}', 'warning')
+        return redirect(f'/supervisor/mark-attendance/{job_id}')
+    
+    verified = [entry[0] for entry in entries if len(entry) > 1 and verify_otp(entry[0], entry[1])]
+    invalid = len(entries) - len(verified)
+    marked, already, unknown = mark_crew(job_id, session['user_id'], date, verified)
+    if len(marked):
+        flash(f'Attendance marked for {len(marked)} workers!', 'success')
+    if len(already):
+        flash(f'Already marked: {", ".join(already["name"])}', 'warning')
+    if unknown:
+        flash(f'Not allocated to this job: {", ".join(unknown)}', 'warning')
+    if invalid:
+        flash(f'Invalid OTP for {invalid} entries!', 'error')
+    return redirect(f'/supervisor/mark-attendance/{job_id}')
 
 @app.route('/supervisor/attendance-summary')
+@page_cache.cached('attendance', 'jobs', 'users')
 def att_summary():
     if 'user_id' not in session or session['role'] != 'supervisor':
         return redirect('/login')
-    attendance = pd.read_csv('data/attendance.csv')
-    users = pd.read_csv('data/users.csv')
-    jobs = pd.read_csv('data/jobs.csv')
-    att = attendance[attendance['supervisor_id'] == session['user_id']]
-    att = att.merge(users[['user_id', 'name']], left_on='worker_id', right_on='user_id', how='left')
-    att = att.merge(jobs[['job_id', 'work_type']], on='job_id', how='left')
-    return render_template('attendance_summary.html', attendance=att.to_dict('records'))
+    where = {**list_filters('attendance'), 'supervisor_id': session['user_id']}
+    page = list_page('attendance', where, ['date', 'job_id', 'worker_id', 'status'], 'date', True)
+    jobs = find_rows('jobs', job_id=page.rows['job_id'].unique())
+    att = join_rows(with_names(page.rows), jobs[['job_id', 'work_type']], 'job_id')
+    page.rows = records(att)
+    return render_template('attendance_summary.html', page=page)
 
 if __name__ == '__main__':
     print("\n" + "="*60)
@@ -0,0 +1,40 @@
+from datetime import datetime
+import pandas as pd
+from storage import find_rows, append_rows, update_rows, locked, next_ids
+from counters import attendance_added
+
+def allocated_workers(job_id, **where):
+    # Users allocated to the job, optionally narrowed by further conditions on users
+    allocated = find_rows('allocations', job_id=job_id, allocation_status='Allocated')
+    return find_rows('users', user_id=allocated['worker_id'].unique(), **where)
+
+def mark_crew(job_id, supervisor_id, date, phones):
+    # Marks every listed worker Present for the job on date with one attendance write and
+    # one users write. Returns the workers marked, those already marked that day and the
+    # phones that do not belong to a worker allocated to the job
+    phones = list(dict.fromkeys(phones))
+    with locked('attendance', 'users', job_id=job_id, phone=phones):
+        workers = allocated_workers(job_id, phone=phones).drop_duplicates('phone')
+        unknown = sorted(set(phones) - set(workers['phone']))
+        marked_ids = set(find_rows('attendance', job_id=job_id, date=date, worker_id=workers['user_id'])['worker_id'])
+        already = workers[workers['user_id'].isin(marked_ids)]
+        workers = workers[~workers['user_id'].isin(marked_ids)].copy()
+        if workers.empty:
+            return workers, already, unknown
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ids = pd.Series(next_ids('attendance', len(workers)))
+        att = pd.DataFrame({
+            'attendance_id': 'ATT' + ids.astype(str).str.zfill(5),
+            'job_id': job_id,
+            'worker_id': workers['user_id'].to_numpy(),
+            'supervisor_id': supervisor_id,
+            'date': date,
+            'status': 'Present',
+            'marked_at': now,
+        })
+        append_rows('attendance', att)
+        attendance_added(att)
+        workers['days_worked'] += 1
+        update_rows('users', workers)
+    return workers, already, unknown
@@ -0,0 +1,149 @@
+import argparse
+import hashlib
+import os
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+from storage import SCHEMAS, table_path
+from allocation import rank_workers
+
+# Synthetic data sets for the benchmarks, written in the same layout as data/*.csv.
+# Every generated user has the password PASSWORD; the first officer, supervisor and worker
+# are gov1@bench.local, sup1@bench.local and worker1@bench.local
+PASSWORD = 'bench'
+
+# Roughly 1k, 100k and 1M attendance rows
+SCALES = {
+    '1k': dict(districts=2, workers=200, jobs=3, months=1, waiting=10),
+    '100k': dict(districts=20, workers=20000, jobs=170, months=2, waiting=50),
+    '1m': dict(districts=50, workers=200000, jobs=1500, months=3, waiting=200),
+}
+
+WORK_TYPES = ['Road Construction', 'Water Tank Repair', 'Canal Desilting', 'Afforestation',
+              'Pond Deepening', 'Rural Housing', 'Drainage Work', 'Check Dam']
+
+def _ids(prefix, start, count, width):
+    return pd.Series(np.arange(start, start + count)).astype(str).str.zfill(width).radd(prefix).to_numpy()
+
+def _timestamps(rng, start, days, count):
+    seconds = rng.integers(0, days * 86400, count)
+    return (pd.Timestamp(start) + pd.to_timedelta(seconds, unit='s')).strftime('%Y-%m-%d %H:%M:%S')
+
+def generate(districts, workers, jobs, months, waiting, seed=0, end=None):
+    # Returns {table: DataFrame}. Attendance covers the `months` before `end`, one row per
+    # allocated worker per working day of each job, about 90% Present
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end or date.today() - timedelta(days=1))
+    start = end - pd.Timedelta(days=30 * months)
+    names = [f'D{i:03d}' for i in range(1, districts + 1)]
+    password = hashlib.sha256(PASSWORD.encode()).hexdigest()
+
+    officers = max(districts // 10, 1)
+    roles = np.array(['government'] * officers + ['supervisor'] * districts + ['worker'] * workers)
+    number = np.arange(1, len(roles) + 1)
+    prefixes = pd.Series(roles).str[:3].str.upper().to_numpy()
+    ordinal = np.concatenate([np.arange(1, officers + 1), np.arange(1, districts + 1), np.arange(1, workers + 1)])
+    handles = np.char.add(np.where(roles == 'government', 'gov', np.where(roles == 'supervisor', 'sup', 'worker')),
+                          ordinal.astype(str))
+    user_district = np.concatenate([np.full(officers, ''), names, rng.choice(names, workers)])
+    users = pd.DataFrame({
+        'user_id': prefixes + pd.Series(number).astype(str).str.zfill(4).to_numpy(),
+        'name': np.char.add('Bench ', handles),
+        'email': np.char.add(handles, '@bench.local'),
+        'phone': (6000000000 + number).astype(str),
+        'password': password,
+        'role': roles,
+        'district': user_district,
+        'aadhaar': (100000000000 + number).astype(str),
+        'disability_status': np.where((roles == 'worker') & (rng.random(len(roles)) < 0.05), 'Yes', 'No'),
+        'days_worked': np.where(roles == 'worker', rng.integers(0, 150, len(roles)), 0),
+        'created_at': _timestamps(rng, start - pd.Timedelta(days=365), 365, len(roles)),
+    })
+
+    job_start = start + pd.to_timedelta(rng.integers(0, max((end - start).days - 7, 1), jobs), unit='D')
+    officer_ids = users['user_id'].to_numpy()[:officers]
+    job_table = pd.DataFrame({
+        'job_id': _ids('JOB', 1, jobs, 4),
+        'district': rng.choice(names, jobs),
+        'work_type': rng.choice(WORK_TYPES, jobs),
+        'start_date': job_start.strftime('%Y-%m-%d'),
+        'duration': rng.integers(7, 61, jobs),
+        'workers_required': rng.integers(5, 41, jobs),
+        'daily_wage': rng.choice([250.0, 300.0, 333.0, 350.0, 400.0], jobs),
+        'status': 'active',
+        'created_by': rng.choice(officer_ids, jobs),
+        'created_at': (job_start - pd.Timedelta(days=3)).strftime('%Y-%m-%d 09:00:00'),
+    })
+
+    # Each job ranks a random slice of its district's workers, as allocate_workers would
+    pool = users[users['role'] == 'worker']
+    by_district = {district: group for district, group in pool.groupby('district')}
+    batches = []
+    for job in job_table.itertuples():
+        group = by_district.get(job.district)
+        if group is None:
+            continue
+        size = min(job.workers_required + waiting, len(group))
+        ranked = rank_workers(group.iloc[np.sort(rng.choice(len(group), size, replace=False))])
+        batches.append(pd.DataFrame({
+            'job_id': job.job_id,
+            'worker_id': ranked['user_id'].to_numpy(),
+            'allocation_status': np.where(np.arange(size) < job.workers_required, 'Allocated', 'Waiting'),
+            'response': rng.choice(['Pending', 'Accepted', 'Rejected'], size, p=[0.3, 0.65, 0.05]),
+            'priority_score': ranked['priority_score'].to_numpy(),
+            'allocated_at': job.created_at,
+        }))
+    allocations = pd.concat(batches, ignore_index=True)
+    allocations.insert(0, 'allocation_id', _ids('ALLOC', 1, len(allocations), 5))
+
+    # One row per allocated worker per day the job ran inside the window
+    allocated = allocations[allocations['allocation_status'] == 'Allocated']
+    allocated = allocated.merge(job_table[['job_id', 'district', 'start_date', 'duration']], on='job_id')
+    supervisors = users[users['role'] == 'supervisor'].set_index('district')['user_id']
+    first = pd.to_datetime(allocated['start_date'])
+    days = np.minimum(allocated['duration'].to_numpy(), (end - first).dt.days.to_numpy() + 1)
+    days = np.maximum(days, 0)
+    rows = np.repeat(np.arange(len(allocated)), days)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(days) - days, days)
+    att_dates = first.to_numpy()[rows] + offsets.astype('timedelta64[D]')
+    attendance = pd.DataFrame({
+        'attendance_id': _ids('ATT', 1, len(rows), 5),
+        'job_id': allocated['job_id'].to_numpy()[rows],
+        'worker_id': allocated['worker_id'].to_numpy()[rows],
+        'supervisor_id': supervisors.reindex(allocated['district']).to_numpy()[rows],
+        'date': pd.DatetimeIndex(att_dates).strftime('%Y-%m-%d'),
+        'status': np.where(rng.random(len(rows)) < 0.9, 'Present', 'Absent'),
+    })
+    attendance['marked_at'] = attendance['date'] + ' 09:' + pd.Series(rng.integers(10, 60, len(rows))).astype(str).to_numpy() + ':00'
+
+    return {
+        'users': users,
+        'jobs': job_table,
+        'allocations': allocations,
+        'attendance': attendance,
+        'wages': pd.DataFrame(columns=list(SCHEMAS['wages'])),
+    }
+
+def write(tables, data_dir):
+    os.makedirs(data_dir, exist_ok=True)
+    for name, df in tables.items():
+        df[list(SCHEMAS[name])].to_csv(table_path(data_dir, name), index=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic portal data set')
+    parser.add_argument('--out', default='bench_data', help='directory for the CSV tables')
+    parser.add_argument('--scale', choices=SCALES, default='1k', help='preset sizes (overridden by the options below)')
+    for option in ('districts', 'workers', 'jobs', 'months', 'waiting'):
+        parser.add_argument(f'--{option}', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sqlite', action='store_true', help='also import the tables into <out>/portal.db')
+    args = parser.parse_args()
+    sizes = {key: getattr(args, key) if getattr(args, key) is not None else value
+             for key, value in SCALES[args.scale].items()}
+    tables = generate(seed=args.seed, **sizes)
+    write(tables, args.out)
+    if args.sqlite:
+        from sqlite_store import import_csv
+        import_csv(args.out)
+    for name, df in tables.items():
+        print(f'{name}: {len(df)} rows')
@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import pandas as pd
+import storage
+import otp_store
+import page_cache
+import tasks
+from benchmark.generate import PASSWORD
+
+# Benchmarks the portal's hot paths through Flask's test client against a copy of a data
+# set written by benchmark.generate, and prints the timings as JSON. Every request runs
+# in this process, so the numbers measure the app and storage code, not the network
+
+GOV, SUPERVISOR, WORKER = 'gov1@bench.local', 'sup1@bench.local', 'worker1@bench.local'
+
+# Read-only pages hit by the concurrent mode, with the role that requests them
+MIXED_LOAD = [
+    ('government', '/government/dashboard'),
+    ('government', '/government/jobs'),
+    ('government', '/government/attendance'),
+    ('government', '/government/wages'),
+    ('worker', '/worker/dashboard'),
+    ('worker', '/worker/attendance'),
+    ('supervisor', '/supervisor/dashboard'),
+    ('supervisor', '/supervisor/attendance-summary'),
+]
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+def summarize(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        'runs': len(ms),
+        'first_ms': round(ms[0], 3),
+        'min_ms': round(min(ms), 3),
+        'mean_ms': round(sum(ms) / len(ms), 3),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(max(ms), 3),
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare(source, backend, period=None):
+    # Benchmarks write to the tables, so they run on a scratch copy of the data set
+    workdir = tempfile.mkdtemp(prefix='portal-bench-')
+    shutil.copytree(source, os.path.join(workdir, 'data'), ignore=shutil.ignore_patterns('.meta', 'portal.db*'))
+    os.chdir(workdir)
+    os.environ['PORTAL_STORAGE_BACKEND'] = backend
+    if backend == 'sqlite':
+        from sqlite_store import import_csv
+        import_csv('data')
+    elif backend == 'sharded':
+        from shards import split
+        split('data')
+    if period:
+        # Attendance in date partitions (csv and sharded)
+        os.environ['PORTAL_ATTENDANCE_PARTITIONS'] = period
+        import partitions
+        partitions.split('data', period)
+    start = time.perf_counter()
+    import app
+    return app.app, workdir, time.perf_counter() - start
+
+def login(flask_app, email):
+    client = flask_app.test_client()
+    response = client.post('/login', data={'email': email, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Could not log in as {email}; was the data set made by benchmark.generate?')
+    return client
+
+def measure(call, repeat, setup=None):
+    timings = []
+    for i in range(repeat):
+        args = setup(i) if setup else ()
+        start = time.perf_counter()
+        response = call(*args)
+        response.get_data()
+        timings.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f'HTTP {response.status_code}')
+    return summarize(timings)
+
+def run_cases(flask_app, repeat):
+    gov, sup, worker = login(flask_app, GOV), login(flask_app, SUPERVISOR), login(flask_app, WORKER)
+    supervisor_district = storage.find_rows('users', email=SUPERVISOR)['district'].iloc[0]
+    job_id = storage.find_rows('jobs')['job_id'].iloc[0]
+
+    # Allocated (job, phone) pairs not yet marked today, handed out in order to the
+    # attendance cases so every timed request records a new row
+    allocated = storage.find_rows('allocations', allocation_status='Allocated')
+    phones = storage.find_rows('users', user_id=allocated['worker_id'].unique()).set_index('user_id')['phone']
+    pairs = iter(zip(allocated['job_id'], phones.reindex(allocated['worker_id'])))
+    crews = iter(allocated.groupby('job_id', sort=False, observed=True)['worker_id'])
+
+    def issue(phone):
+        otp_store.issue_otp(phone, '123456')
+        return phone
+
+    def mark_one(i):
+        job, phone = next(pairs)
+        return job, issue(phone)
+
+    def mark_crew(i):
+        job, worker_ids = next(crews)
+        entries = '\n'.join(f'{issue(phone)} 123456' for phone in phones.reindex(worker_ids))
+        return job, entries
+
+    def finished(response):
+        # Payroll runs as a background task; its cases time the request and the task
+        tasks.join()
+        return response
+
+    def uncached(i):
+        # The page cases time a render; their _cached twins time repeat views
+        page_cache.clear()
+        return ()
+
+    def revalidate(client, path):
+        etag = client.get(path).headers['ETag']
+        return lambda: client.get(path, headers={'If-None-Match': etag})
+
+    def new_attendance(i):
+        job, phone = mark_one(i)
+        sup.post(f'/supervisor/mark-attendance/{job}', data={'phone': phone, 'otp': '123456'})
+        return ()
+
+    cases = [
+        ('login', lambda: flask_app.test_client().post('/login', data={'email': GOV, 'password': PASSWORD}), None, repeat),
+        ('government_dashboard', lambda: gov.get('/government/dashboard'), None, repeat),
+        ('worker_dashboard', lambda: worker.get('/worker/dashboard'), None, repeat),
+        ('supervisor_dashboard', lambda: sup.get('/supervisor/dashboard'), None, repeat),
+        ('government_jobs', lambda: gov.get('/government/jobs'), uncached, repeat),
+        ('government_jobs_cached', lambda: gov.get('/government/jobs'), None, repeat),
+        ('government_jobs_304', revalidate(gov, '/government/jobs'), None, repeat),
+        ('government_attendance', lambda: gov.get('/government/attendance'), None, repeat),
+        ('government_attendance_filtered',
+         lambda: gov.get(f'/government/attendance?district={supervisor_district}&status=Present&sort=date&order=desc'),
+         None, repeat),
+        ('view_allocations', lambda: gov.get(f'/government/allocations/{job_id}'), uncached, repeat),
+        ('view_allocations_cached', lambda: gov.get(f'/government/allocations/{job_id}'), None, repeat),
+        ('attendance_summary', lambda: sup.get('/supervisor/attendance-summary'), uncached, repeat),
+        ('attendance_summary_cached', lambda: sup.get('/supervisor/attendance-summary'), None, repeat),
+        ('worker_jobs', lambda: worker.get('/worker/jobs'), uncached, repeat),
+        ('worker_jobs_cached', lambda: worker.get('/worker/jobs'), None, repeat),
+        ('worker_wages', lambda: worker.get('/worker/wages'), uncached, repeat),
+        ('worker_wages_cached', lambda: worker.get('/worker/wages'), None, repeat),
+        ('export_attendance', lambda: gov.get('/government/export/attendance.csv'), None, max(repeat // 10, 1)),
+        ('create_job', lambda: gov.post('/government/create-job', data={
+            'district': supervisor_district, 'work_type': 'Benchmark', 'start_date': datetime.today().strftime('%Y-%m-%d'),
+            'duration': 30, 'workers_required': 20, 'daily_wage': 300}), None, repeat),
+        ('mark_attendance', lambda job, phone: sup.post(f'/supervisor/mark-attendance/{job}',
+                                                        data={'phone': phone, 'otp': '123456'}), mark_one, repeat),
+        ('mark_crew', lambda job, entries: sup.post(f'/supervisor/mark-attendance/{job}/crew',
+                                                    data={'action': 'mark', 'entries': entries}), mark_crew,
+         max(repeat // 10, 1)),
+        ('calculate_wages_full', lambda: finished(gov.get('/government/calculate-wages')), None, 1),
+        ('calculate_wages', lambda: finished(gov.get('/government/calculate-wages')), new_attendance, repeat),
+        ('government_wages', lambda: gov.get('/government/wages'), None, repeat),
+    ]
+    results = {}
+    for name, call, setup, runs in cases:
+        try:
+            results[name] = measure(call, runs, setup)
+        except StopIteration:
+            results[name] = {'error': 'data set has too few allocated workers for this case'}
+        # Background tasks a case started (job allocation) finish before the next case runs
+        tasks.join()
+        print(f'{name:32} {json.dumps(results[name])}', file=sys.stderr)
+    return results
+
+def run_concurrent(flask_app, clients, requests):
+    # Each thread is one logged-in user of every role cycling through MIXED_LOAD
+    latencies = {path: [] for _, path in MIXED_LOAD}
+    lock = threading.Lock()
+
+    def client_loop(n):
+        sessions = {'government': login(flask_app, GOV), 'worker': login(flask_app, WORKER),
+                    'supervisor': login(flask_app, SUPERVISOR)}
+        mine = {path: [] for _, path in MIXED_LOAD}
+        for i in range(requests):
+            role, path = MIXED_LOAD[(n + i) % len(MIXED_LOAD)]
+            start = time.perf_counter()
+            sessions[role].get(path).get_data()
+            mine[path].append(time.perf_counter() - start)
+        with lock:
+            for path, values in mine.items():
+                latencies[path].extend(values)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(client_loop, range(clients)))
+    elapsed = time.perf_counter() - start
+    everything = [value for values in latencies.values() for value in values]
+    overall = summarize(everything)
+    return {
+        'clients': clients,
+        'requests': len(everything),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(everything) / elapsed, 1),
+        'p50_ms': overall['p50_ms'],
+        'p99_ms': overall['p99_ms'],
+        'endpoints': {path: {key: stats[key] for key in ('runs', 'p50_ms', 'p99_ms')}
+                      for path, stats in ((path, summarize(values)) for path, values in latencies.items() if values)},
+    }
+
+def compare(results, baseline):
+    # Change of the median of every case against an earlier results file
+    for name, stats in results['cases'].items():
+        before = baseline.get('cases', {}).get(name, {}).get('p50_ms')
+        if before and 'p50_ms' in stats:
+            print(f'{name:32} {before:10.2f} -> {stats["p50_ms"]:10.2f} ms  ({stats["p50_ms"] / before:5.2f}x)',
+                  file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the portal routes on a generated data set')
+    parser.add_argument('--data', default='bench_data', help='data set written by benchmark.generate')
+    parser.add_argument('--backend', choices=['csv', 'sqlite', 'sharded'], default='csv')
+    parser.add_argument('--partitions', choices=['month', 'year'], help='partition attendance by this period')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs per case')
+    parser.add_argument('--clients', type=int, default=0, help='also run the concurrent mode with this many threads')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client in the concurrent mode')
+    parser.add_argument('--out', help='write the JSON here instead of stdout')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch copy of the data set')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.data)
+    with contextlib.redirect_stdout(io.StringIO()):
+        flask_app, workdir, startup = prepare(source, args.backend, args.partitions)
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'backend': args.backend,
+            'partitions': args.partitions,
+            'data': source,
+            'rows': {name: storage.count_rows(name) for name in storage.SCHEMAS},
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'startup_ms': round(startup * 1000, 3),
+    }
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['cases'] = run_cases(flask_app, args.repeat)
+        if args.clients:
+            results['concurrent'] = run_concurrent(flask_app, args.clients, args.requests)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
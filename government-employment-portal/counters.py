@@ -0,0 +1,133 @@
+import os
+import pandas as pd
+from storage import (configure, init_tables, read_table, locked, get_counters, add_counters, reset_counters, get_state,
+                     set_state, format_rows, fan_out)
+
+# Dashboard statistics kept up to date as rows are written, so the dashboards read a few
+# counters instead of scanning tables. rebuild_counters() recomputes all of them.
+BUILT_KEY = 'counters.built'
+
+def worker_key(worker_id, stat):
+    return f'worker:{worker_id}:{stat}'
+
+def supervisor_key(supervisor_id, date=None):
+    return f'supervisor:{supervisor_id}:marked' + (f':{date}' if date else '')
+
+def _text(column):
+    # Interned and date columns as plain strings, to build counter keys from
+    return format_rows(column.to_frame())[column.name].astype(str)
+
+def _add_grouped(deltas, keys, values=None):
+    # keys is a Series of counter keys; each key gets the sum of its values (or row count)
+    grouped = keys.value_counts() if values is None else values.groupby(keys.to_numpy()).sum()
+    for key, value in grouped.items():
+        deltas[key] = deltas.get(key, 0) + (value.item() if hasattr(value, 'item') else value)
+
+def user_added(user):
+    if user['role'] == 'worker':
+        add_counters({'workers': 1, 'workers.disabled': int(user['disability_status'] == 'Yes')})
+
+def job_added(job):
+    add_counters({'jobs': 1, 'jobs.active': int(job['status'] == 'active')})
+
+def allocations_added(allocs):
+    allocated = allocs[allocs['allocation_status'] == 'Allocated']
+    deltas = {'allocations.allocated': len(allocated)}
+    _add_grouped(deltas, 'worker:' + _text(allocated['worker_id']) + ':active_jobs')
+    add_counters(deltas)
+
+def allocations_released(allocs):
+    # allocs held a slot (Allocated) and no longer do
+    deltas = {'allocations.allocated': -len(allocs)}
+    _add_grouped(deltas, 'worker:' + _text(allocs['worker_id']) + ':active_jobs', pd.Series(-1, index=allocs.index))
+    add_counters(deltas)
+
+def attendance_added(att):
+    deltas = {}
+    _add_grouped(deltas, 'supervisor:' + _text(att['supervisor_id']) + ':marked')
+    _add_grouped(deltas, 'supervisor:' + _text(att['supervisor_id']) + ':marked:' + _text(att['date']))
+    present = att[att['status'] == 'Present']
+    _add_grouped(deltas, 'worker:' + _text(present['worker_id']) + ':days_present')
+    add_counters(deltas)
+
+def wages_changed(worker_ids, total_deltas):
+    # total_deltas: change of total_wage per row, aligned with worker_ids
+    deltas = {'wages.total': float(total_deltas.sum())}
+    _add_grouped(deltas, 'worker:' + _text(worker_ids) + ':earnings', total_deltas)
+    add_counters(deltas)
+
+def count_values():
+    # Every counter computed from the tables as they are. Counters are sums, so on the sharded
+    # layout each shard's values are added up
+    users = read_table('users')
+    jobs = read_table('jobs')
+    allocations = read_table('allocations')
+    attendance = read_table('attendance')
+    wages = read_table('wages')
+    workers = users[users['role'] == 'worker']
+    allocated = allocations[allocations['allocation_status'] == 'Allocated']
+    present = attendance[attendance['status'] == 'Present']
+    values = {
+        'workers': len(workers),
+        'workers.disabled': int((workers['disability_status'] == 'Yes').sum()),
+        'jobs': len(jobs),
+        'jobs.active': int((jobs['status'] == 'active').sum()),
+        'allocations.allocated': len(allocated),
+        'wages.total': float(wages['total_wage'].sum()),
+    }
+    _add_grouped(values, 'worker:' + _text(allocated['worker_id']) + ':active_jobs')
+    _add_grouped(values, 'worker:' + _text(present['worker_id']) + ':days_present')
+    _add_grouped(values, 'worker:' + _text(wages['worker_id']) + ':earnings', wages['total_wage'])
+    _add_grouped(values, 'supervisor:' + _text(attendance['supervisor_id']) + ':marked')
+    _add_grouped(values, 'supervisor:' + _text(attendance['supervisor_id']) + ':marked:'
+                 + _text(attendance['date']))
+    return values
+
+def rebuild_counters():
+    with locked('users', 'jobs', 'allocations', 'attendance', 'wages'):
+        values = {}
+        for part in fan_out(count_values):
+            for key, value in part.items():
+                values[key] = values.get(key, 0) + value
+        reset_counters(values)
+        set_state(BUILT_KEY, True)
+    return len(values)
+
+def ensure_counters(force=False):
+    if force or not get_state(BUILT_KEY):
+        rebuild_counters()
+
+def government_stats():
+    c = get_counters('workers', 'jobs.active', 'allocations.allocated', 'wages.total', 'workers.disabled')
+    return {
+        'total_workers': int(c['workers']),
+        'active_jobs': int(c['jobs.active']),
+        'workers_allocated': int(c['allocations.allocated']),
+        'wages_paid': c['wages.total'],
+        'disabled_workers': int(c['workers.disabled'])
+    }
+
+def worker_stats(worker_id):
+    keys = [worker_key(worker_id, stat) for stat in ('active_jobs', 'days_present', 'earnings')]
+    c = get_counters(*keys)
+    return {
+        'active_jobs': int(c[keys[0]]),
+        'days_present': int(c[keys[1]]),
+        'total_earnings': c[keys[2]]
+    }
+
+def supervisor_stats(supervisor_id, today):
+    c = get_counters('jobs', supervisor_key(supervisor_id, today), supervisor_key(supervisor_id))
+    return {
+        'total_jobs': int(c['jobs']),
+        'today_attendance': int(c[supervisor_key(supervisor_id, today)]),
+        'total_marked': int(c[supervisor_key(supervisor_id)])
+    }
+
+if __name__ == '__main__':
+    backend = os.environ.get('PORTAL_STORAGE_BACKEND', 'csv')
+    partitions = os.environ.get('PORTAL_ATTENDANCE_PARTITIONS') or None
+    configure(backend, **({'partitions': partitions} if backend != 'sqlite' else {}))
+    # Refuses a data directory laid out for other settings
+    init_tables()
+    print(f'Rebuilt {rebuild_counters()} counters')
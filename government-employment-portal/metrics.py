@@ -0,0 +1,237 @@
+import contextvars
+import cProfile
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+# Per-request instrumentation. The storage layer reports the tables, bytes and rows it
+# touches to the request being served; after each request the numbers are added to
+# per-endpoint totals, served at /metrics in the Prometheus text format. Requests slower
+# than SLOW_REQUEST_MS are logged with their breakdown. Totals are per process.
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Per-request totals exported as <name>_total counters, with their help text
+TOTALS = {
+    'tables_read': 'Tables read (distinct per request)',
+    'tables_written': 'Tables written (distinct per request)',
+    'bytes_read': 'Bytes parsed from table files',
+    'bytes_written': 'Bytes written to table files',
+    'rows_scanned': 'Rows scanned by the CSV backend or returned by SQLite',
+    'rows_written': 'Rows appended or updated',
+    'storage_seconds': 'Seconds spent in storage calls',
+    'parse_seconds': 'Seconds spent parsing CSV',
+    'render_seconds': 'Seconds spent rendering templates',
+    'page_cache_hits': 'Pages served from the page cache, as 200 or 304',
+}
+
+slow_log = logging.getLogger('portal.slow')
+
+
+class RequestStats:
+    __slots__ = ('start', 'read', 'written', 'bytes_read', 'bytes_written', 'rows_scanned', 'rows_written',
+                 'storage_seconds', 'parse_seconds', 'render_seconds', 'render_start', 'profiler', 'in_storage',
+                 'page_cache_hits')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.read = set()
+        self.written = set()
+        self.bytes_read = self.bytes_written = self.rows_scanned = self.rows_written = 0
+        self.storage_seconds = self.parse_seconds = self.render_seconds = 0.0
+        self.render_start = None
+        self.profiler = None
+        self.in_storage = False
+        self.page_cache_hits = 0
+
+    def totals(self):
+        return {
+            'tables_read': len(self.read), 'tables_written': len(self.written),
+            'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+            'rows_scanned': self.rows_scanned, 'rows_written': self.rows_written,
+            'storage_seconds': self.storage_seconds, 'parse_seconds': self.parse_seconds,
+            'render_seconds': self.render_seconds, 'page_cache_hits': self.page_cache_hits,
+        }
+
+
+# Hooks called by the storage layer; they do nothing outside a request
+
+def record_read(table, rows=0, nbytes=0):
+    stats = _current.get()
+    if stats is not None:
+        stats.read.add(table)
+        stats.rows_scanned += rows
+        stats.bytes_read += nbytes
+
+
+def record_write(table, rows=0, nbytes=0):
+    stats = _current.get()
+    if stats is not None:
+        stats.written.add(table)
+        stats.rows_written += rows
+        stats.bytes_written += nbytes
+
+
+def record_parse(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.parse_seconds += seconds
+
+
+def record_cache_hit():
+    stats = _current.get()
+    if stats is not None:
+        stats.page_cache_hits += 1
+
+
+def timed(func):
+    # Adds the call's duration to the request's storage time; nested calls count once
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stats = _current.get()
+        if stats is None or stats.in_storage:
+            return func(*args, **kwargs)
+        stats.in_storage, start = True, time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.storage_seconds += time.perf_counter() - start
+            stats.in_storage = False
+    return wrapper
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.totals = defaultdict(lambda: dict.fromkeys(TOTALS, 0))
+        self.slow = defaultdict(int)
+
+    def add(self, endpoint, method, status, seconds, stats, slow):
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            self.counts[endpoint] += 1
+            self.seconds[endpoint] += seconds
+            buckets = self.buckets[endpoint]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            totals = self.totals[endpoint]
+            for key, value in stats.totals().items():
+                totals[key] += value
+            if slow:
+                self.slow[endpoint] += 1
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP portal_requests_total Requests handled.', '# TYPE portal_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'portal_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            lines += ['# HELP portal_request_duration_seconds Request wall time.',
+                      '# TYPE portal_request_duration_seconds histogram']
+            for endpoint in sorted(self.counts):
+                for bound, count in zip(BUCKETS, self.buckets[endpoint]):
+                    lines.append(f'portal_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'portal_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {self.counts[endpoint]}')
+                lines.append(f'portal_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.seconds[endpoint]:.6f}')
+                lines.append(f'portal_request_duration_seconds_count{{endpoint="{endpoint}"}} {self.counts[endpoint]}')
+            for key, help_text in TOTALS.items():
+                lines += [f'# HELP portal_{key}_total {help_text}.', f'# TYPE portal_{key}_total counter']
+                for endpoint in sorted(self.totals):
+                    value = self.totals[endpoint][key]
+                    lines.append(f'portal_{key}_total{{endpoint="{endpoint}"}} {value:.6f}' if isinstance(value, float)
+                                 else f'portal_{key}_total{{endpoint="{endpoint}"}} {value}')
+            lines += ['# HELP portal_slow_requests_total Requests over the slow-request threshold.',
+                      '# TYPE portal_slow_requests_total counter']
+            for endpoint, count in sorted(self.slow.items()):
+                lines.append(f'portal_slow_requests_total{{endpoint="{endpoint}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_profile_lock = threading.Lock()
+
+
+def init_app(app):
+    from flask import Response, request, template_rendered, before_render_template
+    config = app.config
+    config.setdefault('SLOW_REQUEST_MS', 500)
+    config.setdefault('SLOW_LOG', '')
+    config.setdefault('PROFILE_SAMPLE_RATE', 0)
+    config.setdefault('PROFILE_DIR', os.path.join('data', '.meta', 'profiles'))
+    if config['SLOW_LOG']:
+        handler = logging.FileHandler(config['SLOW_LOG'])
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.propagate = False
+
+    @app.before_request
+    def start_request():
+        stats = RequestStats()
+        _current.set(stats)
+        # One profiled request at a time; cProfile cannot run in two threads at once
+        if config['PROFILE_SAMPLE_RATE'] and random.random() < config['PROFILE_SAMPLE_RATE'] \
+                and _profile_lock.acquire(blocking=False):
+            stats.profiler = cProfile.Profile()
+            stats.profiler.enable()
+
+    @app.after_request
+    def finish_request(response):
+        stats = _current.get()
+        if stats is None:
+            return response
+        seconds = time.perf_counter() - stats.start
+        endpoint = request.endpoint or 'unmatched'
+        slow = seconds * 1000 >= config['SLOW_REQUEST_MS']
+        registry.add(endpoint, request.method, response.status_code, seconds, stats, slow)
+        if stats.profiler is not None:
+            stats.profiler.disable()
+            _profile_lock.release()
+            os.makedirs(config['PROFILE_DIR'], exist_ok=True)
+            stats.profiler.dump_stats(os.path.join(
+                config['PROFILE_DIR'], f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{seconds * 1000:.0f}ms.prof'))
+            stats.profiler = None
+        if slow:
+            slow_log.warning(
+                '%s %s %s %.1fms storage=%.1fms parse=%.1fms render=%.1fms read=%s written=%s '
+                'rows_scanned=%d rows_written=%d bytes_read=%d bytes_written=%d',
+                request.method, request.full_path.rstrip('?'), response.status_code, seconds * 1000,
+                stats.storage_seconds * 1000, stats.parse_seconds * 1000, stats.render_seconds * 1000,
+                ','.join(sorted(stats.read)) or '-', ','.join(sorted(stats.written)) or '-',
+                stats.rows_scanned, stats.rows_written, stats.bytes_read, stats.bytes_written)
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        stats = _current.get()
+        if stats is not None and stats.profiler is not None:
+            stats.profiler.disable()
+            _profile_lock.release()
+        _current.set(None)
+
+    def render_started(sender, template, context, **extra):
+        stats = _current.get()
+        if stats is not None:
+            stats.render_start = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        stats = _current.get()
+        if stats is not None and stats.render_start is not None:
+            stats.render_seconds += time.perf_counter() - stats.render_start
+            stats.render_start = None
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
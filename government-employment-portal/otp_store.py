@@ -0,0 +1,123 @@
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from storage import DATA_DIR, meta_path
+
+# Attendance OTPs, keyed by phone. Issuing a code replaces any earlier one for the phone,
+# a code expires after OTP_TTL seconds and is removed by the first successful verify
+OTP_TTL = 600
+# Expired codes that are never verified are swept out at most this often
+PURGE_INTERVAL = 60
+
+
+class MemoryOTPStore:
+    # Codes live in this process only; use the sqlite store when running several workers
+    name = 'memory'
+
+    def __init__(self, ttl=OTP_TTL):
+        self.ttl = ttl
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + PURGE_INTERVAL
+
+    def _purge(self, now):
+        expired = [phone for phone, (_, expires) in self._codes.items() if expires <= now]
+        for phone in expired:
+            del self._codes[phone]
+        self._next_purge = now + PURGE_INTERVAL
+        return len(expired)
+
+    def issue(self, phone, otp):
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_purge:
+                self._purge(now)
+            self._codes[phone] = (str(otp), now + self.ttl)
+
+    def verify(self, phone, otp):
+        now = time.monotonic()
+        with self._lock:
+            code = self._codes.get(phone)
+            if code is None:
+                return False
+            if code[1] <= now:
+                del self._codes[phone]
+                return False
+            if not hmac.compare_digest(code[0].encode(), str(otp).encode()):
+                return False
+            del self._codes[phone]
+            return True
+
+    def purge(self):
+        with self._lock:
+            return self._purge(time.monotonic())
+
+
+class SQLiteOTPStore:
+    # Shared by every process using the same file; codes carry a wall-clock expiry time
+    name = 'sqlite'
+
+    def __init__(self, data_dir=DATA_DIR, path=None, ttl=OTP_TTL):
+        self.path = path or meta_path(data_dir, 'otp.db')
+        self.ttl = ttl
+        self._local = threading.local()
+        self._next_purge = 0
+
+    def conn(self):
+        # One connection per thread, reopened after a fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('CREATE TABLE IF NOT EXISTS otp (phone TEXT PRIMARY KEY, otp TEXT, expires_at REAL)')
+            local.pid = os.getpid()
+        return local.conn
+
+    def issue(self, phone, otp):
+        now = time.time()
+        if now >= self._next_purge:
+            self.purge()
+        self.conn().execute('INSERT OR REPLACE INTO otp (phone, otp, expires_at) VALUES (?, ?, ?)',
+                            (phone, str(otp), now + self.ttl))
+
+    def verify(self, phone, otp):
+        # Deleting the matching live row is the check, so a code can only be used once even
+        # when two processes verify it at the same time
+        cursor = self.conn().execute('DELETE FROM otp WHERE phone = ? AND otp = ? AND expires_at > ?',
+                                     (phone, str(otp), time.time()))
+        return cursor.rowcount == 1
+
+    def purge(self):
+        now = time.time()
+        self._next_purge = now + PURGE_INTERVAL
+        return self.conn().execute('DELETE FROM otp WHERE expires_at <= ?', (now,)).rowcount
+
+
+_store = None
+
+
+def configure(backend='memory', data_dir=DATA_DIR, ttl=OTP_TTL):
+    global _store
+    if backend == 'memory':
+        _store = MemoryOTPStore(ttl)
+    elif backend == 'sqlite':
+        _store = SQLiteOTPStore(data_dir, ttl=ttl)
+    else:
+        raise ValueError(f'Unknown OTP store: {backend}')
+    return _store
+
+
+def get_store():
+    if _store is None:
+        configure()
+    return _store
+
+
+def issue_otp(phone, otp):
+    get_store().issue(phone, otp)
+
+
+def check_otp(phone, otp):
+    return get_store().verify(phone, otp)
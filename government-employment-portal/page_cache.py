@@ -0,0 +1,93 @@
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, session, make_response
+from storage import table_versions
+from metrics import record_cache_hit
+
+# Rendered pages of the read-heavy routes, kept in this process. A page is cached per URL
+# (with its query string) and signed-in user, together with the versions of the tables its
+# route reads (storage.table_versions); it is served again only while those are unchanged, so
+# any write to one of the tables, by any process, invalidates it. The least recently used
+# pages are dropped once the cached bodies pass the memory cap. Cached pages carry an ETag,
+# and a request whose If-None-Match still matches gets a 304 without the page being rendered.
+# A request with flashed messages to show is always rendered, and never cached
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_size = 0
+_max_bytes = 64 * 1024 * 1024
+
+
+def configure(max_mb=64):
+    # max_mb=0 turns the cache off
+    global _max_bytes
+    _max_bytes = int(max_mb * 1024 * 1024)
+    clear()
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def _get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+        return entry
+
+
+def _put(key, entry):
+    global _size
+    size = len(entry[2])
+    if size > _max_bytes:
+        return
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _size -= len(old[2])
+        _entries[key] = entry
+        _size += size
+        while _size > _max_bytes:
+            _, old = _entries.popitem(last=False)
+            _size -= len(old[2])
+
+
+def _conditional(response, etag):
+    response.set_etag(etag)
+    # Per-user pages; the browser keeps them but asks again on every view
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def cached(*tables):
+    # Caches the pages of a route that reads the given tables (all of them, including the ones
+    # only read for names or joins)
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _max_bytes or 'user_id' not in session or '_flashes' in session:
+                return view(*args, **kwargs)
+            key = (request.endpoint, request.full_path, session['user_id'], session.get('role'))
+            entry = _get(key)
+            # Taken before rendering: a write during the render leaves the entry stale, not wrong
+            versions = table_versions(*tables)
+            if entry is not None and entry[0] == versions:
+                record_cache_hit()
+                response = make_response(entry[2])
+                response.mimetype = entry[3]
+                return _conditional(response, entry[1])
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            etag = hashlib.sha1(body).hexdigest()
+            _put(key, (versions, etag, body, response.mimetype))
+            return _conditional(response, etag)
+        return wrapper
+    return decorator
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import shutil
+import pandas as pd
+from storage import (DATA_DIR, SCHEMAS, PARTITIONED, PERIODS, CSVBackend, stack_rows, partition_keys, table_path,
+                     meta_path)
+from payroll import CURSOR_KEY
+import snapshots
+
+# Moves the PARTITIONED tables (attendance) of a data directory from one CSV file each into one
+# file per month or year (see storage.PartitionedTable), or back. On the sharded layout every
+# district's shard is converted. The payroll cursor, a row count of the unpartitioned table,
+# becomes a row count per partition and back. Run it with the app stopped, then start the app
+# with PORTAL_ATTENDANCE_PARTITIONS set to the same period (or unset after a merge).
+
+
+def _stores(data_dir):
+    # The backends to convert, each with its own tables and payroll cursor
+    if os.path.isdir(os.path.join(data_dir, 'shards')):
+        from shards import ShardedBackend
+        sharded = ShardedBackend(data_dir, workers=0)
+        return [sharded.shard(district) for district in sharded.districts()]
+    return [CSVBackend(data_dir)]
+
+
+def _period(data_dir, name):
+    try:
+        with open(meta_path(data_dir, f'{name}.partitions.json')) as f:
+            return json.load(f)['period']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def split(data_dir=DATA_DIR, period='month'):
+    # Returns the number of rows per table
+    counts = dict.fromkeys(PARTITIONED, 0)
+    for store in _stores(data_dir):
+        source = CSVBackend(store.data_dir)
+        target = CSVBackend(store.data_dir, period)
+        for name, column in PARTITIONED.items():
+            # Refuses a table that is partitioned already
+            source.init([name])
+            # Both backends lock the table through the same lock file; only the target's is taken
+            with target.locked(name):
+                df = source.read(name)
+                target.write(name, df)
+                if name == 'attendance':
+                    cursor = store.get_state(CURSOR_KEY)
+                    if cursor is not None:
+                        paid = pd.Series(partition_keys(period, df[column].iloc[:cursor])).value_counts()
+                        store.set_state(CURSOR_KEY, {key: int(count) for key, count in paid.items()})
+                os.remove(table_path(store.data_dir, name))
+                snapshots.remove(meta_path(store.data_dir, 'snapshots'), name)
+            counts[name] += len(df)
+    return counts
+
+
+def merge(data_dir=DATA_DIR):
+    # The reverse of split; returns the number of rows per table
+    counts = dict.fromkeys(PARTITIONED, 0)
+    for store in _stores(data_dir):
+        target = CSVBackend(store.data_dir)
+        for name in PARTITIONED:
+            period = _period(store.data_dir, name)
+            if period is None:
+                continue
+            source = CSVBackend(store.data_dir, period).table(name)
+            with target.locked(name):
+                parts = source.parts()
+                frames = [part.read() for part in parts]
+                if name == 'attendance':
+                    cursor = store.get_state(CURSOR_KEY)
+                    if isinstance(cursor, dict):
+                        # Rows payroll has counted go first, so the cursor is again a row count
+                        counted = [cursor.get(part.part, 0) for part in parts]
+                        frames = ([frame.iloc[:count] for frame, count in zip(frames, counted)]
+                                  + [frame.iloc[count:] for frame, count in zip(frames, counted)])
+                        store.set_state(CURSOR_KEY, sum(counted))
+                df = stack_rows(frames, SCHEMAS[name])
+                target.write(name, df)
+                shutil.rmtree(source.directory)
+                shutil.rmtree(os.path.join(meta_path(store.data_dir, 'snapshots'), name), ignore_errors=True)
+                os.remove(source.index_path)
+            counts[name] += len(df)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the attendance table into date partitions, or merge them back')
+    parser.add_argument('command', choices=['split', 'merge'])
+    parser.add_argument('--period', choices=list(PERIODS), default='month', help='partition period for split')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    args = parser.parse_args()
+    counts = split(args.data_dir, args.period) if args.command == 'split' else merge(args.data_dir)
+    for name, count in counts.items():
+        print(f'{name}: {count} rows')
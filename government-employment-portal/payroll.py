@@ -0,0 +1,124 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from storage import (find_rows, append_rows, update_rows, locked, next_ids, rows_since, get_state, set_state,
+                     join_rows, get_backend, fan_out)
+from counters import wages_changed
+
+# High-water mark: position in attendance up to which wages have been brought up to date
+CURSOR_KEY = 'payroll.attendance_cursor'
+# The cursor a run started from and the days held by each wage row it writes, kept until it
+# has saved the next cursor
+RUN_KEY = 'payroll.run'
+
+def _pairs(df):
+    # Each row's (worker, job) as one integer, from the interned codes, for matching pairs
+    # across frames without merging on the categoricals
+    return (df['worker_id'].cat.codes.to_numpy().astype(np.int64) << 32) | df['job_id'].cat.codes.to_numpy()
+
+def run_payroll(progress=None):
+    # Adds the Present days marked since the last run to the Pending wage row of every (worker,
+    # job), creating the row the first time. Returns the number of wage rows touched, or None
+    # when there was no new attendance. progress(done, total) counts wage rows
+    with locked('wages'):
+        cursor = get_state(CURSOR_KEY)
+        new, end = rows_since('attendance', cursor or 0)
+        present = new[new['status'] == 'Present']
+        if present.empty:
+            if end != cursor:
+                set_state(CURSOR_KEY, end)
+            return None
+
+        days = present.groupby(['worker_id', 'job_id'], observed=True).size().rename('days').reset_index()
+        jobs = find_rows('jobs', job_id=days['job_id'].unique())[['job_id', 'daily_wage']]
+        days = join_rows(days, jobs, 'job_id', how='inner')
+        keys = _pairs(days)
+
+        wages = find_rows('wages', worker_id=days['worker_id'].unique())
+        pending = (wages['payment_status'] == 'Pending').to_numpy()
+        if cursor is None:
+            # Every day is counted afresh; days already in rows that are no longer Pending stay
+            # out of the Pending row
+            settled = wages[~pending]
+            settled = pd.Series(settled['days_present'].to_numpy(), index=_pairs(settled)).groupby(level=0).sum()
+            days['days'] -= settled.reindex(keys, fill_value=0).to_numpy()
+        pending = wages[pending]
+        held = pending['days_present'].to_numpy()
+        run = get_state(RUN_KEY)
+        if run is not None and run['cursor'] == cursor:
+            # A run from this cursor stopped before saving the next one: the rows it may have
+            # written count from the days they held before it
+            saved = pd.Series(run['days'], dtype='int64')
+            ids = pending['wage_id'].astype(str)
+            held = np.where(ids.isin(saved.index).to_numpy(), saved.reindex(ids).fillna(0).to_numpy(np.int64), held)
+        if cursor is not None:
+            held_days = pd.Series(held, index=_pairs(pending)).groupby(level=0).sum()
+            days['days'] += held_days.reindex(keys, fill_value=0).to_numpy()
+
+        # The old calculation appended a Pending row per run, so a pair can have several: the
+        # latest one gets the pair's days and the others are zeroed
+        older = pd.Series(_pairs(pending)).duplicated(keep='last').to_numpy()
+        duplicates = older & np.isin(_pairs(pending), keys) & \
+            ((pending['days_present'] != 0) | (pending['total_wage'] != 0)).to_numpy()
+        latest = np.flatnonzero(~older)
+        rows = pd.Index(_pairs(pending)[latest]).get_indexer(keys)
+        found = rows >= 0
+        rows = latest[rows[found]]
+        # A pair whose days have all been settled does not get a new row
+        fresh = days[~found & (days['days'] > 0).to_numpy()].copy()
+        if not fresh.empty:
+            ids = pd.Series(next_ids('wages', len(fresh)), index=fresh.index)
+            fresh['wage_id'] = 'WAGE' + ids.astype(str).str.zfill(5)
+
+        # Saved before any row is written, so a rerun from this cursor knows what every row it
+        # touches held, whichever of them this run gets to write
+        touched = np.concatenate([np.flatnonzero(duplicates), rows])
+        before = dict(zip(pending['wage_id'].astype(str).to_numpy()[touched].tolist(), held[touched].tolist()))
+        set_state(RUN_KEY, {'cursor': cursor, 'days': {**before, **dict.fromkeys(fresh.get('wage_id', []), 0)}})
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        duplicates = pending[duplicates].copy()
+        if not duplicates.empty:
+            previous_total = duplicates['total_wage'].copy()
+            duplicates['days_present'] = 0
+            duplicates['total_wage'] = 0.0
+            duplicates['calculated_at'] = now
+            update_rows('wages', duplicates)
+            wages_changed(duplicates['worker_id'], -previous_total)
+
+        if progress:
+            progress(0, len(days))
+
+        existing = pending.iloc[rows].copy()
+        if not existing.empty:
+            previous_total = existing['total_wage'].to_numpy()
+            existing['days_present'] = days['days'].to_numpy()[found]
+            existing['daily_wage'] = days['daily_wage'].to_numpy()[found]
+            existing['total_wage'] = existing['days_present'] * existing['daily_wage']
+            existing['calculated_at'] = now
+            update_rows('wages', existing)
+            wages_changed(existing['worker_id'], existing['total_wage'] - previous_total)
+            if progress:
+                progress(len(existing), len(days))
+
+        if not fresh.empty:
+            fresh['days_present'] = fresh['days']
+            fresh['total_wage'] = fresh['days_present'] * fresh['daily_wage']
+            fresh['payment_status'] = 'Pending'
+            fresh['calculated_at'] = now
+            append_rows('wages', fresh)
+            wages_changed(fresh['worker_id'], fresh['total_wage'])
+
+        set_state(CURSOR_KEY, end)
+        set_state(RUN_KEY, None)
+        if progress:
+            progress(len(days), len(days))
+        return len(existing) + len(fresh)
+
+def calculate_wages(progress=None):
+    # run_payroll for the whole state. On the sharded layout every district's shard runs it in
+    # parallel (progress then counts shards) and the wage rows touched are added up
+    if get_backend().name != 'sharded':
+        return run_payroll(progress)
+    touched = [count for count in fan_out(run_payroll, progress=progress) if count is not None]
+    return sum(touched) if touched else None
@@ -0,0 +1,537 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from urllib.parse import quote, unquote
+import numpy as np
+import pandas as pd
+from storage import (DATA_DIR, SCHEMAS, CSVBackend, stack_rows, page_rows, is_list_value, parse_condition, interned,
+                     space_of, table_path, meta_path, has_rows, find_rows, count_rows, csv_chunks, using)
+from payroll import CURSOR_KEY
+import snapshots
+
+# District-sharded layout: users, jobs, allocations, attendance and wages are split into one
+# directory of CSV tables per district (data/shards/district=<name>/), so a lookup by district
+# or job reads only that district's files. Users and jobs are placed by their district column,
+# the other tables by the district of their job. The tasks table, ID sequences, counters and
+# state stay in data/. State-wide work goes through fan_out(), which runs a function on every
+# shard in a pool of worker processes; each worker sees its shard as the whole data set. With
+# partitions, every shard keeps its attendance in date partitions (see partitions.py). Table
+# locks are per shard, and a write locks only the shards it touches (see locked()).
+
+SHARDED = ['users', 'jobs', 'allocations', 'attendance', 'wages']
+# Tables placed by their own district column; the rest follow their job
+DISTRICT_TABLES = ['users', 'jobs']
+SHARD_PREFIX = 'district='
+# Exports whose matching rows a worker process keeps between their chunks
+EXPORTS_KEPT = 4
+
+
+def _text(value):
+    return '' if value is None or value != value else str(value)
+
+
+class ShardView(CSVBackend):
+    # The tables of one district as a backend of their own. Tables that are not sharded, IDs and
+    # counters are the data set's; state is kept per shard (key@district), so the payroll cursor
+    # of a shard counts that shard's attendance rows
+    def __init__(self, parent, district):
+        super().__init__(parent.shard_path(district), parent.partitions)
+        self.parent = parent
+        self.district = district
+        self.counters = parent.counters
+
+    def table(self, name):
+        return super().table(name) if name in SHARDED else self.parent.table(name)
+
+    def next_ids(self, name, count):
+        return self.parent.next_ids(name, count)
+
+    def get_state(self, key, default=None):
+        return self.parent.get_state(f'{key}@{self.district}', default)
+
+    def set_state(self, key, value):
+        self.parent.set_state(f'{key}@{self.district}', value)
+
+
+class ShardedBackend(CSVBackend):
+    name = 'sharded'
+
+    def __init__(self, data_dir=DATA_DIR, workers=None, partitions=None):
+        # workers: processes fan_out runs shards on (default: one per CPU); 1 or 0 runs them
+        # one after another in the calling thread. partitions applies to every shard
+        super().__init__(data_dir, partitions)
+        self.shard_root = os.path.join(data_dir, 'shards')
+        self.workers = os.cpu_count() if workers is None else workers
+        self._shards = {}
+        self._created = set()
+        self._job_districts = {}
+        self._jobs_seen = {}
+        self._held = {}
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+
+    def init(self):
+        super().init([name for name in SCHEMAS if name not in SHARDED])
+        os.makedirs(self.shard_root, exist_ok=True)
+        for name in SHARDED:
+            path = table_path(self.data_dir, name)
+            if has_rows(path):
+                raise RuntimeError(f'{path} has rows outside the district shards; run python shards.py split')
+        for district in self.districts():
+            self.shard(district).init(SHARDED)
+
+    def shard_path(self, district):
+        return os.path.join(self.shard_root, SHARD_PREFIX + quote(district, safe=''))
+
+    def districts(self):
+        # Every district with a shard, including the ones other processes have added
+        try:
+            entries = os.listdir(self.shard_root)
+        except FileNotFoundError:
+            return []
+        return sorted(unquote(entry[len(SHARD_PREFIX):]) for entry in entries if entry.startswith(SHARD_PREFIX))
+
+    def shard(self, district):
+        shard = self._shards.get(district)
+        if shard is None:
+            with self._tables_lock:
+                shard = self._shards.setdefault(district, ShardView(self, district))
+        return shard
+
+    def _create(self, district):
+        if district in self._created:
+            return
+        path = self.shard_path(district)
+        if not os.path.isdir(path):
+            # Built under a temporary name and renamed into place, so no process ever sees a
+            # shard without its tables
+            os.makedirs(self.shard_root, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.shard_root, prefix='.new-')
+            CSVBackend(tmp, self.partitions).init(SHARDED)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Another process created it first
+                shutil.rmtree(tmp, ignore_errors=True)
+        self._created.add(district)
+
+    def job_districts(self, job_ids):
+        # District of each job ('' for unknown jobs). A job never changes district, so the
+        # mapping is only extended, from the jobs shards that changed since they were last seen
+        job_ids = [_text(job_id) for job_id in job_ids]
+        if any(job_id not in self._job_districts for job_id in job_ids):
+            for district in self.districts():
+                jobs = self.shard(district).read('jobs')
+                if self._jobs_seen.get(district) is not jobs:
+                    self._job_districts.update(dict.fromkeys(jobs['job_id'].astype(str), district))
+                    self._jobs_seen[district] = jobs
+        return [self._job_districts.get(job_id, '') for job_id in job_ids]
+
+    def _holds(self, district, frame, name, col, values):
+        # Whether the shard's column has any of values: codes for an interned column, checked
+        # against its sorted distinct codes, or text, checked against the set of its values.
+        # Both are kept per shard and remade when its table changes
+        held = self._held.get((district, name, col))
+        if held is None or held[0] is not frame:
+            column = frame[col]
+            held = (frame, np.unique(column.array.codes) if space_of(column) else set(column.tolist()))
+            self._held[district, name, col] = held
+        held = held[1]
+        if isinstance(held, set):
+            return not held.isdisjoint(values)
+        return len(held) > 0 and (held[np.searchsorted(held, values).clip(max=len(held) - 1)] == values).any()
+
+    def _districts_for(self, name, where):
+        # The shards that can hold rows matching where: those of the districts or jobs asked for,
+        # less the ones an equality condition on a text or interned column rules out (e.g. a
+        # worker's rows are only read from the shards that hold their worker_id)
+        if name in DISTRICT_TABLES and 'district' in where:
+            values = where['district']
+            values = [_text(value) for value in (values if is_list_value(values) else [values])]
+        elif name != 'users' and 'job_id' in where:
+            values = where['job_id']
+            values = self.job_districts(values if is_list_value(values) else [values])
+        else:
+            values = None
+        districts = self.districts()
+        if values is not None:
+            districts = sorted(set(values).intersection(districts))
+        frames = None
+        for field, value in where.items():
+            col, op = parse_condition(field)
+            kind = SCHEMAS[name].get(col, '')
+            if op != 'eq' or kind.partition(':')[0] not in ('str', 'cat') or len(districts) < 2:
+                continue
+            # Loaded first, so every value they hold has its code
+            frames = frames or {district: self.shard(district).read(name) for district in districts}
+            values = [_text(v) for v in (value if is_list_value(value) else [value])]
+            if kind.startswith('cat:'):
+                values = interned(kind).values.get_indexer(values)
+            districts = [district for district in districts
+                         if self._holds(district, frames[district], name, col, values)]
+        return districts
+
+    def _split(self, name, rows):
+        # rows (a DataFrame or a list of dicts) as (district, rows of that district) pairs
+        col = 'district' if name in DISTRICT_TABLES else 'job_id'
+        if isinstance(rows, pd.DataFrame):
+            values = rows[col].astype(str).fillna('')
+            if col == 'job_id':
+                values = values.map(dict(zip(values.unique(), self.job_districts(values.unique()))))
+        else:
+            values = [_text(row.get(col)) for row in rows]
+            if col == 'job_id':
+                values = self.job_districts(values)
+        codes, districts = pd.factorize(pd.Series(values, dtype=object))
+        for i, district in enumerate(districts):
+            mask = codes == i
+            yield district, rows[mask] if isinstance(rows, pd.DataFrame) else [row for row, m in zip(rows, mask) if m]
+
+    def _concat(self, name, frames):
+        return stack_rows(frames, SCHEMAS[name])
+
+    def read(self, name):
+        if name not in SHARDED:
+            return super().read(name)
+        return self._concat(name, [self.shard(district).read(name) for district in self.districts()])
+
+    def find(self, name, **where):
+        if name not in SHARDED:
+            return super().find(name, **where)
+        return self._concat(name, [self.shard(district).find(name, **where)
+                                   for district in self._districts_for(name, where)])
+
+    def count(self, name, **where):
+        if name not in SHARDED:
+            return super().count(name, **where)
+        return sum(self.shard(district).count(name, **where) for district in self._districts_for(name, where))
+
+    def sum(self, name, column, **where):
+        if name not in SHARDED:
+            return super().sum(name, column, **where)
+        return sum(self.shard(district).sum(name, column, **where) for district in self._districts_for(name, where))
+
+    def query(self, name, order_by=None, descending=False, limit=None, offset=0, **where):
+        if name not in SHARDED:
+            return super().query(name, order_by, descending, limit, offset, **where)
+        districts = self._districts_for(name, where)
+        if len(districts) == 1:
+            return self.shard(districts[0]).query(name, order_by, descending, limit, offset, **where)
+        # Insertion order goes shard by shard, so an unsorted page is a slice of one or a few
+        frames = [self.shard(district).find(name, **where) for district in districts]
+        return page_rows(frames, SCHEMAS[name], order_by, descending, limit, offset)
+
+    def iter_chunks(self, name, chunk_size, order_by=None, descending=False, **where):
+        if name not in SHARDED or order_by:
+            yield from super().iter_chunks(name, chunk_size, order_by, descending, **where)
+            return
+        districts = self._districts_for(name, where)
+        for district in reversed(districts) if descending else districts:
+            yield from self.shard(district).iter_chunks(name, chunk_size, None, descending, **where)
+
+    def iter_csv(self, name, chunk_size, **where):
+        # Chunks of chunk_size rows in district order. Worker processes format them, a few chunks
+        # ahead of the one being sent; rows a shard gets after its rows were counted are left out
+        if name not in SHARDED:
+            yield from super().iter_csv(name, chunk_size, **where)
+            return
+        districts = self._districts_for(name, where)
+        if self.workers <= 1 or len(districts) < 2:
+            for district in districts:
+                yield from self.shard(district).iter_csv(name, chunk_size, **where)
+            return
+        export = uuid.uuid4().hex
+        counts = list(self.map_shards(_shard_count, name, where, districts=districts))
+        pool = self._executor()
+        futures = deque()
+        try:
+            for district, count in zip(districts, counts):
+                for start in range(0, count, chunk_size):
+                    futures.append(pool.submit(_shard_csv, export, district, name, start, chunk_size, where))
+                    if len(futures) > 2 * self.workers:
+                        yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        except BrokenProcessPool:
+            self._drop_pool()
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def write(self, name, df):
+        if name not in SHARDED:
+            return super().write(name, df)
+        parts = dict(self._split(name, df))
+        for district in parts:
+            self._create(district)
+        with self.locked(name):
+            for district in self.districts():
+                self.shard(district).write(name, parts.get(district, df.iloc[:0]))
+
+    def append(self, name, rows):
+        if name not in SHARDED:
+            return super().append(name, rows)
+        parts = list(self._split(name, rows))
+        self._check_held(name, [district for district, _ in parts])
+        for district, part in parts:
+            self._create(district)
+            self.shard(district).append(name, part)
+
+    def update(self, name, rows):
+        if name not in SHARDED:
+            return super().update(name, rows)
+        parts = list(self._split(name, rows))
+        self._check_held(name, [district for district, _ in parts])
+        for district, part in parts:
+            self._create(district)
+            self.shard(district).update(name, part)
+
+    def _lock_districts(self, name, where):
+        # The shards of name a lock with these conditions covers: those its rows go to by
+        # district or job, else those holding rows that match the other conditions (the rows
+        # about to be updated), else all of them
+        where = {field: value for field, value in where.items() if parse_condition(field)[0] in SCHEMAS[name]}
+        col = 'district' if name in DISTRICT_TABLES else 'job_id'
+        if col in where:
+            values = where[col] if is_list_value(where[col]) else [where[col]]
+            if col == 'job_id':
+                # Rows of an unknown job go to the '' shard, like its district
+                districts = set(self.job_districts(values))
+            else:
+                districts = {_text(value) for value in values}
+            for district in districts:
+                # A district's first rows are about to be written; its shard is made now to be locked
+                self._create(district)
+            return sorted(districts)
+        if where:
+            return self._districts_for(name, where)
+        return self.districts()
+
+    def _holding(self):
+        # The (table, district) shard locks this thread holds through locked(), with their depth
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def _check_held(self, name, districts):
+        # Inside a locked() of name, its shards can only be locked again or written to if the
+        # block holds them already. Taking another one there would break the (table, district)
+        # order, and could deadlock with a process taking the same locks in order; it happens
+        # when the block's conditions miss the rows, or the shard was created during the block
+        held = self._holding()
+        if any(key[0] == name for key in held):
+            missing = [district for district in districts if (name, district) not in held]
+            if missing:
+                raise RuntimeError(f'{name} shards {missing} are not held by the enclosing locked(); '
+                                   f'give it conditions that cover these rows')
+
+    @contextmanager
+    def locked(self, *names, **where):
+        # A sharded table is locked by holding the lock of each of its shards that where can
+        # involve (see storage.locked); without conditions, every one of them. Locks are always
+        # taken in (table, district) order, and writes inside the block must go to shards it
+        # holds (see _check_held)
+        held = self._holding()
+        taken = []
+        with ExitStack() as stack:
+            for name in sorted(set(names)):
+                if name in SHARDED:
+                    districts = self._lock_districts(name, where)
+                    self._check_held(name, districts)
+                    for district in districts:
+                        stack.enter_context(self.shard(district).table(name).lock)
+                        taken.append((name, district))
+                    # Marks the table as locked by this block even when no shard matched
+                    taken.append((name, None))
+                else:
+                    stack.enter_context(self.table(name).lock)
+            for key in taken:
+                held[key] = held.get(key, 0) + 1
+            try:
+                yield
+            finally:
+                for key in taken:
+                    held[key] -= 1
+                    if not held[key]:
+                        del held[key]
+
+    def rows_since(self, name, cursor):
+        # cursor maps each district to a row count of its shard
+        if name not in SHARDED:
+            return super().rows_since(name, cursor)
+        if not isinstance(cursor, dict):
+            if cursor:
+                raise ValueError('Row-count cursors of the unsharded layout do not apply to shards')
+            cursor = {}
+        frames, end = [], {}
+        for district in self.districts():
+            frame, end[district] = self.shard(district).rows_since(name, cursor.get(district, 0))
+            frames.append(frame)
+        return self._concat(name, frames), end
+
+    def versions(self, names):
+        # A sharded table's version is its shards', so a new shard changes it too
+        versions = super().versions([name for name in names if name not in SHARDED])
+        districts = self.districts()
+        for name in names:
+            if name in SHARDED:
+                versions[name] = tuple((district, self.shard(district).table(name).version())
+                                       for district in districts)
+        return versions
+
+    def compact(self):
+        super().compact([name for name in SCHEMAS if name not in SHARDED])
+        for district in self.districts():
+            self.shard(district).compact(SHARDED)
+
+    def _executor(self):
+        with self._pool_lock:
+            # A forked child (e.g. a server worker) inherits the parent's pool but cannot use it
+            if self._pool is None or self._pool_pid != os.getpid():
+                # Forked, so workers start with the modules loaded; each opens its own backend
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=context, initializer=_start_worker,
+                                                 initargs=(self.data_dir, self.partitions))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _drop_pool(self):
+        with self._pool_lock:
+            self._pool = None
+
+    def map_shards(self, func, *args, districts=None):
+        # func(*args) run with each shard as the backend; yields the results in district order
+        districts = self.districts() if districts is None else districts
+        if self.workers <= 1 or len(districts) < 2:
+            for district in districts:
+                with using(self.shard(district)):
+                    result = func(*args)
+                yield result
+            return
+        pool = self._executor()
+        futures = [pool.submit(_in_shard, district, func, args) for district in districts]
+        try:
+            for future in futures:
+                yield future.result()
+        except BrokenProcessPool:
+            self._drop_pool()
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def fan_out(self, func, *args, progress=None):
+        districts = self.districts()
+        results = []
+        for result in self.map_shards(func, *args, districts=districts):
+            results.append(result)
+            if progress:
+                progress(len(results), len(districts))
+        return results
+
+
+_worker = None
+_exports = OrderedDict()
+
+
+def _start_worker(data_dir, partitions):
+    global _worker
+    _worker = ShardedBackend(data_dir, workers=0, partitions=partitions)
+
+
+def _in_shard(district, func, args):
+    with using(_worker.shard(district)):
+        return func(*args)
+
+
+def _shard_count(name, where):
+    return count_rows(name, **where)
+
+
+def _shard_csv(export, district, name, start, chunk_size, where):
+    # One chunk of an export as CSV text. The shard's matching rows are found for the first
+    # chunk this worker formats and kept for the export's next ones
+    key = (export, district)
+    rows = _exports.get(key)
+    if rows is None:
+        with using(_worker.shard(district)):
+            rows = find_rows(name, **where)
+        _exports[key] = rows
+        while len(_exports) > EXPORTS_KEPT:
+            _exports.popitem(last=False)
+    return ''.join(csv_chunks([rows.iloc[start:start + chunk_size]]))
+
+
+def split(data_dir=DATA_DIR):
+    # Moves the sharded tables of an unsharded data directory into district shards. Run it with
+    # the app stopped; returns the number of rows per table
+    source = CSVBackend(data_dir)
+    source.init()
+    target = ShardedBackend(data_dir, workers=0)
+    if target.districts():
+        raise RuntimeError(f'{target.shard_root} already holds shards')
+    counts = {}
+    with source.locked(*SHARDED):
+        # Jobs first: the other tables are placed by the district of their job
+        for name in sorted(SHARDED, key=lambda name: name != 'jobs'):
+            df = source.read(name)
+            target.write(name, df)
+            counts[name] = len(df)
+        # The payroll cursor counts the attendance rows already paid; each shard gets the count
+        # of its own rows among them
+        cursor = source.get_state(CURSOR_KEY)
+        if cursor is not None:
+            paid = source.read('attendance').iloc[:cursor]
+            per_district = {district: len(rows) for district, rows in target._split('attendance', paid)}
+            for district in target.districts():
+                target.shard(district).set_state(CURSOR_KEY, per_district.get(district, 0))
+        for name in SHARDED:
+            os.remove(table_path(data_dir, name))
+            snapshots.remove(meta_path(data_dir, 'snapshots'), name)
+    return counts
+
+
+def merge(data_dir=DATA_DIR):
+    # The reverse of split: the shards are joined back into one table each, district by district
+    source = ShardedBackend(data_dir, workers=0)
+    # Refuses shards whose attendance is partitioned
+    source.init()
+    target = CSVBackend(data_dir)
+    counts = {}
+    with source.locked(*SHARDED):
+        districts = source.districts()
+        cursors = [source.shard(district).get_state(CURSOR_KEY) for district in districts]
+        for name in SHARDED:
+            frames = [source.shard(district).read(name) for district in districts]
+            if name == 'attendance':
+                # Rows payroll has counted go first, so the cursor is again a row count
+                frames = ([frame.iloc[:cursor or 0] for frame, cursor in zip(frames, cursors)]
+                          + [frame.iloc[cursor or 0:] for frame, cursor in zip(frames, cursors)])
+            df = source._concat(name, frames)
+            target.write(name, df)
+            counts[name] = len(df)
+        target.set_state(CURSOR_KEY, None if all(c is None for c in cursors) else sum(c or 0 for c in cursors))
+    shutil.rmtree(source.shard_root)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split the portal tables into district shards, or merge them back')
+    parser.add_argument('command', choices=['split', 'merge'])
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    args = parser.parse_args()
+    for name, count in (split if args.command == 'split' else merge)(args.data_dir).items():
+        print(f'{name}: {count} rows')
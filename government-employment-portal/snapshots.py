@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+# Binary copies of parsed CSV tables. Numeric and date columns are stored as .npy arrays and
+# text columns dictionary-encoded (int32 codes plus the distinct values), so loading one is a
+# memory-mapped read from the OS page cache instead of a CSV parse. <name>.json names the
+# current snapshot of a table and records which prefix of the CSV file it was made from;
+# the CSV stays the source of truth and a snapshot that no longer matches it is ignored.
+#
+# A loaded frame keeps its numeric and date columns as read-only maps of the files, so every
+# process that loads the same snapshot shares their pages. So do the codes of an interned
+# column whose values map to the same codes in this process (e.g. the first table to load
+# them), as long as its space is too large for pandas to narrow them below int32 (more than
+# 32767 values, such as the IDs of a large table); other codes are translated into a private
+# array. Text columns are Python objects and are always built in each process. A column is
+# only copied once the table changes (see storage.replace_rows and concat_rows).
+
+
+def save(directory, name, df, schema, info):
+    folder = f'{name}-{uuid.uuid4().hex[:12]}'
+    path = os.path.join(directory, folder)
+    os.makedirs(path)
+    for col, kind in schema.items():
+        if kind == 'str':
+            # Same text a CSV round trip would give back
+            codes, values = pd.factorize(df[col].fillna('').astype(str))
+            np.save(os.path.join(path, f'{col}.codes.npy'), codes.astype(np.int32))
+            np.save(os.path.join(path, f'{col}.values.npy'), np.asarray(values, dtype=str))
+        elif kind.startswith('cat:'):
+            # Codes of an interned space are only valid in this process; store the text
+            codes, used = pd.factorize(df[col].cat.codes.to_numpy())
+            np.save(os.path.join(path, f'{col}.codes.npy'), codes.astype(np.int32))
+            np.save(os.path.join(path, f'{col}.values.npy'),
+                    np.asarray(df[col].cat.categories[used], dtype=str))
+        else:
+            np.save(os.path.join(path, f'{col}.npy'), df[col].to_numpy())
+    manifest = os.path.join(directory, f'{name}.json')
+    with open(f'{manifest}.tmp', 'w') as f:
+        json.dump({**info, 'folder': folder, 'schema': schema, 'rows': len(df)}, f)
+    os.replace(f'{manifest}.tmp', manifest)
+    for entry in os.listdir(directory):
+        if entry.startswith(f'{name}-') and entry != folder:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def load(directory, name, schema, interned):
+    # Returns (df, info), or None when there is no usable snapshot. interned(kind) is the space
+    # the values of a cat:<space> column are interned in
+    try:
+        with open(os.path.join(directory, f'{name}.json')) as f:
+            info = json.load(f)
+        if info['schema'] != schema:
+            return None
+        path = os.path.join(directory, info['folder'])
+        data = {}
+        for col, kind in schema.items():
+            if kind == 'str':
+                codes = np.load(os.path.join(path, f'{col}.codes.npy'), mmap_mode='r')
+                values = np.load(os.path.join(path, f'{col}.values.npy')).astype(object)
+                data[col] = values[codes]
+            elif kind.startswith('cat:'):
+                codes = np.load(os.path.join(path, f'{col}.codes.npy'), mmap_mode='r')
+                values = np.load(os.path.join(path, f'{col}.values.npy')).astype(object)
+                data[col] = interned(kind).categorical(codes, values)
+            else:
+                data[col] = np.load(os.path.join(path, f'{col}.npy'), mmap_mode='r')
+            if len(data[col]) != info['rows']:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    # copy=False keeps the maps as the columns instead of consolidating them into new blocks
+    return pd.DataFrame(data, copy=False), info
+
+
+def remove(directory, name):
+    # Deletes a table's snapshot, e.g. once its rows have moved to another data directory
+    if not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry == f'{name}.json':
+            os.remove(os.path.join(directory, entry))
+        elif entry.startswith(f'{name}-'):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
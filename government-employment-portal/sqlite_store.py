@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pandas as pd
+from storage import (DATA_DIR, SCHEMAS, KEYS, DATE_FORMATS, CSVBackend, max_id, coerce_types, format_rows,
+                     is_list_value, parse_condition, csv_chunks)
+from metrics import record_read, record_write
+
+# Interned (cat:<space>) and date columns are stored as their text
+SQL_TYPES = {'str': 'TEXT', 'cat': 'TEXT', 'date': 'TEXT', 'datetime': 'TEXT', 'int': 'INTEGER', 'float': 'REAL',
+             'bool': 'INTEGER'}
+
+# Secondary indexes for the lookups the routes make; primary keys are indexed by SQLite
+INDEXES = {
+    'users': [['email'], ['phone']],
+    'allocations': [['job_id', 'worker_id'], ['worker_id']],
+    'attendance': [['worker_id', 'job_id', 'date'], ['supervisor_id']],
+    'wages': [['worker_id']],
+}
+
+SQL_OPERATORS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+
+# Longer value lists are bound as one JSON array instead of one parameter per value, to stay
+# under SQLite's limit on bound parameters per statement
+MAX_PARAMS = 900
+
+
+def _param(value):
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _sql_value(kind, value):
+    value = _param(value)
+    if kind in DATE_FORMATS and hasattr(value, 'strftime') and value == value:
+        return value.strftime(DATE_FORMATS[kind])
+    if kind in ('str', 'cat', 'date', 'datetime'):
+        return '' if value is None or value != value else str(value)
+    if kind == 'int':
+        return int(value or 0)
+    if kind == 'float':
+        return float(value or 0)
+    return int(str(value).lower() in ('true', '1'))
+
+
+class SQLiteBackend:
+    # All tables in one SQLite file; lookups become indexed queries instead of scans
+    name = 'sqlite'
+
+    def __init__(self, data_dir=DATA_DIR, path=None):
+        self.data_dir = data_dir
+        self.path = path or os.path.join(data_dir, 'portal.db')
+        self._local = threading.local()
+
+    def conn(self):
+        # One connection per thread, reopened after a fork
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def locked(self, *names, **where):
+        # SQLite has a single writer lock per database, so every table shares it; nested
+        # calls join the outer transaction
+        conn = self.conn()
+        if self._local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.execute('COMMIT')
+
+    def init(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self.locked():
+            conn = self.conn()
+            for name, schema in SCHEMAS.items():
+                cols = ', '.join(f'{col} {SQL_TYPES[kind.partition(":")[0]]}' for col, kind in schema.items())
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {name} ({cols}, PRIMARY KEY ({", ".join(KEYS[name])}))')
+                for index in INDEXES.get(name, []):
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_{"_".join(index)} ON {name} ({", ".join(index)})')
+            conn.execute('CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value NUMERIC)')
+            conn.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def _where(self, name, where):
+        clauses, params = [], []
+        for field, value in where.items():
+            col, op = parse_condition(field)
+            if col not in SCHEMAS[name]:
+                raise ValueError(f'Unknown column {name}.{col}')
+            if is_list_value(value) and op in ('eq', 'ne'):
+                values = [_param(v) for v in dict.fromkeys(value)]
+                negate = 'NOT ' if op == 'ne' else ''
+                if len(values) > MAX_PARAMS:
+                    clauses.append(f'{col} {negate}IN (SELECT value FROM json_each(?))')
+                    params.append(json.dumps(values))
+                else:
+                    clauses.append(f'{col} {negate}IN ({", ".join("?" * len(values))})')
+                    params.extend(values)
+            else:
+                clauses.append(f'{col} {SQL_OPERATORS[op]} ?')
+                params.append(_param(value))
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    def _order(self, name, order_by, descending):
+        direction = ' DESC' if descending else ''
+        if order_by and order_by not in SCHEMAS[name]:
+            raise ValueError(f'Unknown column {name}.{order_by}')
+        return f' ORDER BY {order_by}{direction}, rowid{direction}' if order_by else f' ORDER BY rowid{direction}'
+
+    def find(self, name, **where):
+        cols = ', '.join(SCHEMAS[name])
+        clause, params = self._where(name, where)
+        df = pd.read_sql_query(f'SELECT {cols} FROM {name}{clause} ORDER BY rowid', self.conn(), params=params)
+        record_read(name, len(df))
+        return coerce_types(df, SCHEMAS[name])
+
+    def read(self, name):
+        return self.find(name)
+
+    def count(self, name, **where):
+        clause, params = self._where(name, where)
+        record_read(name)
+        return self.conn().execute(f'SELECT COUNT(*) FROM {name}{clause}', params).fetchone()[0]
+
+    def sum(self, name, column, **where):
+        clause, params = self._where(name, where)
+        record_read(name)
+        return self.conn().execute(f'SELECT COALESCE(SUM({column}), 0) FROM {name}{clause}', params).fetchone()[0]
+
+    def query(self, name, order_by=None, descending=False, limit=None, offset=0, **where):
+        cols = ', '.join(SCHEMAS[name])
+        clause, params = self._where(name, where)
+        sql = f'SELECT {cols} FROM {name}{clause}{self._order(name, order_by, descending)}'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params = params + [limit, offset]
+        df = coerce_types(pd.read_sql_query(sql, self.conn(), params=params), SCHEMAS[name])
+        record_read(name, len(df))
+        return df, self.count(name, **where)
+
+    def iter_chunks(self, name, chunk_size, order_by=None, descending=False, **where):
+        # Rows are streamed from the cursor chunk by chunk, never loaded all at once. A
+        # separate connection keeps the open cursor out of this thread's transactions
+        cols = ', '.join(SCHEMAS[name])
+        clause, params = self._where(name, where)
+        sql = f'SELECT {cols} FROM {name}{clause}{self._order(name, order_by, descending)}'
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            for chunk in pd.read_sql_query(sql, conn, params=params, chunksize=chunk_size):
+                record_read(name, len(chunk))
+                yield coerce_types(chunk, SCHEMAS[name])
+        finally:
+            conn.close()
+
+    def iter_csv(self, name, chunk_size, **where):
+        return csv_chunks(self.iter_chunks(name, chunk_size, **where))
+
+    def _values(self, name, rows, columns):
+        kinds = [SCHEMAS[name][col].partition(':')[0] for col in columns]
+        if isinstance(rows, pd.DataFrame):
+            rows = format_rows(rows).to_dict('records')
+        return [[_sql_value(kind, row.get(col)) for col, kind in zip(columns, kinds)] for row in rows]
+
+    def _bump(self, name):
+        # Inside the write's transaction, so readers see the new rows and version together
+        self.conn().execute('INSERT INTO versions (name, value) VALUES (?, 1) '
+                            'ON CONFLICT (name) DO UPDATE SET value = value + 1', (name,))
+
+    def append(self, name, rows):
+        cols = list(SCHEMAS[name])
+        record_write(name, len(rows))
+        with self.locked(name):
+            self.conn().executemany(
+                f'INSERT INTO {name} ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))})',
+                self._values(name, rows, cols))
+            self._bump(name)
+
+    def update(self, name, rows):
+        key = KEYS[name]
+        cols = [col for col in SCHEMAS[name] if col not in key]
+        record_write(name, len(rows))
+        with self.locked(name):
+            self.conn().executemany(
+                f'UPDATE {name} SET {", ".join(f"{col} = ?" for col in cols)} '
+                f'WHERE {" AND ".join(f"{col} = ?" for col in key)}',
+                self._values(name, rows, cols + key))
+            self._bump(name)
+
+    def write(self, name, df):
+        with self.locked(name):
+            self.conn().execute(f'DELETE FROM {name}')
+            self.append(name, df)
+
+    def next_ids(self, name, count):
+        with self.locked(name):
+            conn = self.conn()
+            row = conn.execute('SELECT value FROM sequences WHERE name = ?', (name,)).fetchone()
+            if row:
+                last = row[0]
+            else:
+                key = KEYS[name][0]
+                last = max_id(r[0] for r in conn.execute(f'SELECT {key} FROM {name}'))
+            conn.execute('INSERT OR REPLACE INTO sequences (name, value) VALUES (?, ?)', (name, last + count))
+            return range(last + 1, last + count + 1)
+
+    def rows_since(self, name, cursor):
+        # cursor is the last rowid seen; the rowid B-tree makes this proportional to new rows
+        cols = ', '.join(SCHEMAS[name])
+        df = pd.read_sql_query(f'SELECT rowid AS _rowid, {cols} FROM {name} WHERE rowid > ? ORDER BY rowid',
+                               self.conn(), params=[cursor])
+        record_read(name, len(df))
+        if not df.empty:
+            cursor = int(df['_rowid'].iloc[-1])
+        return coerce_types(df.drop(columns='_rowid'), SCHEMAS[name]), cursor
+
+    def versions(self, names):
+        # A per-table write count, kept in the database so every process sees the same
+        versions = dict.fromkeys(names, 0)
+        versions.update(self.conn().execute(
+            f'SELECT name, value FROM versions WHERE name IN ({", ".join("?" * len(versions))})', list(versions)))
+        return versions
+
+    def get_state(self, key, default=None):
+        row = self.conn().execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        with self.locked():
+            self.conn().execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_counters(self, keys):
+        values = dict.fromkeys(keys, 0)
+        keys = list(values)
+        for i in range(0, len(keys), MAX_PARAMS):
+            chunk = keys[i:i + MAX_PARAMS]
+            values.update(self.conn().execute(
+                f'SELECT key, value FROM counters WHERE key IN ({", ".join("?" * len(chunk))})', chunk))
+        return values
+
+    def add_counters(self, deltas):
+        with self.locked():
+            self.conn().executemany(
+                'INSERT INTO counters (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = value + excluded.value',
+                [(key, _param(delta)) for key, delta in deltas.items() if delta])
+
+    def reset_counters(self, values):
+        with self.locked():
+            self.conn().execute('DELETE FROM counters')
+            self.conn().executemany('INSERT INTO counters (key, value) VALUES (?, ?)',
+                                    [(key, _param(value)) for key, value in values.items() if value])
+
+    def compact(self):
+        self.conn().execute('PRAGMA optimize')
+
+
+def import_csv(data_dir=DATA_DIR, path=None):
+    # One-shot copy of the CSV tables into the SQLite database, replacing its contents
+    source = CSVBackend(data_dir)
+    # Tables added since the data set was written are created empty
+    source.init()
+    target = SQLiteBackend(data_dir, path)
+    target.init()
+    counts = {}
+    with target.locked():
+        for name in SCHEMAS:
+            df = source.read(name)
+            target.write(name, df)
+            counts[name] = len(df)
+        target.conn().execute('DELETE FROM sequences')
+        target.conn().execute('DELETE FROM state')
+        target.conn().execute('DELETE FROM counters')
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the portal CSV tables into SQLite')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--db', default=None, help='database file (default: <data-dir>/portal.db)')
+    args = parser.parse_args()
+    for name, count in import_csv(args.data_dir, args.db).items():
+        print(f'{name}: {count} rows')
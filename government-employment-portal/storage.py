@@ -0,0 +1,1402 @@
+import contextvars
+import csv
+import io
+import json
+import operator
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from metrics import record_read, record_write, record_parse, timed
+import snapshots
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DATA_DIR = 'data'
+
+# Column order and type of every table; the CSV header follows this order. Besides str, int
+# (int32), float and bool, a column can be:
+#   date, datetime  parsed once into datetime64 and written back as YYYY-MM-DD[ HH:MM:SS]
+#   cat:<space>     categorical whose values are interned in a process-wide space (see Interned);
+#                   columns of one space, such as every user ID column, join on their integer codes
+SCHEMAS = {
+    'users': {
+        'user_id': 'cat:user', 'name': 'str', 'email': 'str', 'phone': 'str', 'password': 'str',
+        'role': 'cat:role', 'district': 'cat:district', 'aadhaar': 'str', 'disability_status': 'cat:yes_no',
+        'days_worked': 'int', 'created_at': 'datetime',
+    },
+    'jobs': {
+        'job_id': 'cat:job', 'district': 'cat:district', 'work_type': 'cat:work_type', 'start_date': 'date',
+        'duration': 'int', 'workers_required': 'int', 'daily_wage': 'float', 'status': 'cat:job_status',
+        'created_by': 'cat:user', 'created_at': 'datetime',
+    },
+    'allocations': {
+        'allocation_id': 'str', 'job_id': 'cat:job', 'worker_id': 'cat:user',
+        'allocation_status': 'cat:allocation_status', 'response': 'cat:response', 'priority_score': 'int',
+        'allocated_at': 'datetime',
+    },
+    'attendance': {
+        'attendance_id': 'str', 'job_id': 'cat:job', 'worker_id': 'cat:user', 'supervisor_id': 'cat:user',
+        'date': 'date', 'status': 'cat:attendance_status', 'marked_at': 'datetime',
+    },
+    'wages': {
+        'wage_id': 'str', 'worker_id': 'cat:user', 'job_id': 'cat:job', 'days_present': 'int',
+        'daily_wage': 'float', 'total_wage': 'float', 'payment_status': 'cat:payment_status',
+        'calculated_at': 'datetime',
+    },
+    # Background work queue (see tasks.py); params and result are JSON and plain text
+    'tasks': {
+        'task_id': 'str', 'kind': 'cat:task_kind', 'params': 'str', 'status': 'cat:task_status',
+        'progress': 'int', 'total': 'int', 'result': 'str', 'error': 'str', 'owner': 'str',
+        'created_by': 'str', 'created_at': 'datetime', 'started_at': 'datetime', 'finished_at': 'datetime',
+    },
+}
+
+# Text columns of digits. Rows saved when pandas guessed them to be floats hold values such as
+# 123456789101.0, which are read back without the .0
+DIGIT_TEXT = {'phone', 'aadhaar'}
+DATE_FORMATS = {'date': '%Y-%m-%d', 'datetime': '%Y-%m-%d %H:%M:%S'}
+# Kind of every date column by name, for frames that no longer belong to one table
+DATE_COLUMNS = {col: kind for schema in SCHEMAS.values() for col, kind in schema.items() if kind in DATE_FORMATS}
+
+
+# Primary key of every table. Updates are appended as a new version of the row and the
+# last version of a key wins when the file is read back
+KEYS = {
+    'users': ['user_id'],
+    'jobs': ['job_id'],
+    'allocations': ['allocation_id'],
+    'attendance': ['attendance_id'],
+    'wages': ['wage_id'],
+    'tasks': ['task_id'],
+}
+
+# A table is rewritten without its superseded rows once they exceed both limits
+COMPACT_MIN_STALE = 1000
+COMPACT_STALE_RATIO = 0.25
+
+# Tables of at least SNAPSHOT_MIN_ROWS rows keep a binary snapshot (see snapshots.py), remade
+# once the rows parsed from the CSV since the last one exceed SNAPSHOT_STALE_RATIO of it
+SNAPSHOT_MIN_ROWS = 10000
+SNAPSHOT_STALE_RATIO = 0.1
+# Bytes before the end of the snapshotted prefix kept to check the CSV still starts with it
+SNAPSHOT_CHECK_BYTES = 256
+
+# Tables that can be kept as one CSV file per period of a date column (see PartitionedTable),
+# with that column
+PARTITIONED = {'attendance': 'date'}
+# Periods a table can be partitioned by, as pandas period frequencies
+PERIODS = {'month': 'M', 'year': 'Y'}
+# Partition of the rows without a date
+UNDATED = 'undated'
+# A partition is closed, i.e. read-only, once its period ended more than this many days ago
+CLOSE_AFTER_DAYS = 7
+
+# The process umask, read once at import since reading it means setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def table_path(data_dir, name):
+    return os.path.join(data_dir, f'{name}.csv')
+
+
+def meta_path(data_dir, filename):
+    # Lock files and ID sequences live next to the tables
+    path = os.path.join(data_dir, '.meta')
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, filename)
+
+
+def has_rows(path):
+    # Whether a table file exists and has a line after its header
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        f.readline()
+        return bool(f.readline().strip())
+
+
+def partition_key(period, value):
+    # Partition of one date (or its text), e.g. '2025-01' by month; UNDATED when it is not a date
+    try:
+        value = pd.Timestamp(value)
+    except (ValueError, TypeError):
+        return UNDATED
+    return UNDATED if value is pd.NaT else str(value.to_period(PERIODS[period]))
+
+
+def partition_keys(period, values):
+    # partition_key of every value, as an array
+    dates = pd.to_datetime(pd.Series(values), format='ISO8601', errors='coerce')
+    keys = dates.dt.to_period(PERIODS[period]).astype(str).to_numpy(dtype=object)
+    keys[dates.isna().to_numpy()] = UNDATED
+    return keys
+
+
+def period_closed(period, key):
+    if key == UNDATED:
+        return False
+    last_day = pd.Period(key, PERIODS[period]).end_time.normalize()
+    return pd.Timestamp.today().normalize() - last_day > pd.Timedelta(days=CLOSE_AFTER_DAYS)
+
+
+def _file_mode(path):
+    # Permission bits of path, or those a new file gets from open() if there is none
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+class FileLock:
+    # Exclusive lock shared by the threads of this process (re-entrant) and, through flock,
+    # by every other process using the same data directory
+    def __init__(self, path):
+        self.path = path
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._rlock.acquire()
+        if self._depth == 0:
+            try:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._rlock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._rlock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Interned:
+    # The values of one categorical space, shared by every table of the process. A value keeps
+    # the code it got when first seen and new values only ever go at the end, so the codes of
+    # frames loaded at different times agree and serve as integer keys for joins
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self.values = pd.Index([], dtype=object, name=name)
+        self.dtype = pd.CategoricalDtype(self.values)
+
+    def _codes(self, values):
+        # Codes of distinct text values, adding the ones not seen yet
+        with self._lock:
+            codes = self.values.get_indexer(values)
+            if (codes == -1).any():
+                new = pd.unique(values[codes == -1])
+                self.values = self.values.append(pd.Index(new, dtype=object, name=self.values.name))
+                self.dtype = pd.CategoricalDtype(self.values)
+                codes = self.values.get_indexer(values)
+            return codes, self.dtype
+
+    def categorical(self, codes, values):
+        # values[codes] as a categorical of this space
+        mapping, dtype = self._codes(pd.Index(values, dtype=object).fillna('').astype(str))
+        if np.array_equal(mapping, np.arange(len(mapping))):
+            # Already this space's codes; used as they are, without translating a copy
+            return pd.Categorical.from_codes(codes, dtype=dtype)
+        return pd.Categorical.from_codes(mapping[codes], dtype=dtype)
+
+    def encode(self, column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes, values = column.cat.codes.to_numpy(), column.cat.categories
+            if (codes == -1).any():
+                codes, values = np.where(codes == -1, len(values), codes), values.append(pd.Index(['']))
+        else:
+            codes, values = pd.factorize(column.fillna(''))
+        return self.categorical(codes, values)
+
+
+_spaces = {}
+_spaces_lock = threading.Lock()
+_named_locks = {}
+
+
+def interned(kind):
+    name = kind.partition(':')[2]
+    space = _spaces.get(name)
+    if space is None:
+        with _spaces_lock:
+            space = _spaces.setdefault(name, Interned(name))
+    return space
+
+
+def space_of(column):
+    # Name of the space of an interned column, None for any other column
+    return column.cat.categories.name if isinstance(column.dtype, pd.CategoricalDtype) else None
+
+
+def coerce_types(df, schema):
+    for col, kind in schema.items():
+        if kind == 'int':
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype('int32')
+        elif kind == 'float':
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0).astype('float64')
+        elif kind == 'bool':
+            df[col] = df[col].astype(str).str.lower().isin(['true', '1'])
+        elif kind in DATE_FORMATS:
+            df[col] = pd.to_datetime(df[col], format='ISO8601', errors='coerce')
+            if kind == 'date':
+                df[col] = df[col].dt.normalize()
+        elif kind.startswith('cat:'):
+            df[col] = interned(kind).encode(df[col])
+        elif col in DIGIT_TEXT:
+            df[col] = digit_text(df[col])
+    return df
+
+
+def digit_text(column):
+    # A DIGIT_TEXT column without the .0 of values saved as floats
+    if column.dtype != object:
+        return column
+    float_text = column.str.fullmatch(r'\d+\.0', na=False)
+    return column.where(~float_text, column.str[:-2]) if float_text.any() else column
+
+
+def date_text(values, kind):
+    # Dates as the text stored in the files. strftime per row is slow, so every distinct day
+    # and time of day is formatted once and the row's text assembled from those
+    values = np.asarray(values, dtype='datetime64[s]')
+    missing = np.isnat(values)
+    seconds = values.astype('int64')
+    seconds[missing] = 0
+    days, clock = np.divmod(seconds, 86400)
+    day_codes, day_values = pd.factorize(days)
+    text = np.datetime_as_string(day_values.astype('datetime64[D]')).astype(object)[day_codes]
+    if kind == 'datetime':
+        clock_codes, clock_values = pd.factorize(clock)
+        clock_text = np.array([f' {s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in clock_values.tolist()],
+                              dtype=object)
+        text = text + clock_text[clock_codes]
+    text[missing] = ''
+    return text
+
+
+def format_rows(df):
+    # df with its date and interned columns as plain text, the way the CSV files hold them, for
+    # writing out or rendering. (to_csv would format every value of a column's space)
+    columns = [col for col, dtype in df.dtypes.items() if dtype.kind == 'M' or isinstance(dtype, pd.CategoricalDtype)]
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for col in columns:
+        if df[col].dtype.kind == 'M':
+            df[col] = date_text(df[col].to_numpy(), DATE_COLUMNS.get(col, 'datetime'))
+        else:
+            df[col] = df[col].to_numpy()
+    return df
+
+
+def concat_rows(frames, schema):
+    # pd.concat keeps a categorical column only when its dtype is the same in every frame, so
+    # interned columns are joined on their codes, under the current dtype of their space
+    data = {}
+    for col, kind in schema.items():
+        # The arrays behind the columns; going through Series (.cat.codes) costs more than the copy
+        columns = [frame[col].array for frame in frames]
+        if kind.startswith('cat:'):
+            codes = np.concatenate([column.codes.astype(np.int32) for column in columns])
+            data[col] = pd.Categorical.from_codes(codes, dtype=interned(kind).dtype)
+        else:
+            data[col] = np.concatenate([np.asarray(column) for column in columns])
+    return pd.DataFrame(data)
+
+
+def replace_rows(df, positions, rows, schema):
+    # Overwrites the rows of df at positions with rows. Each column is replaced by an updated
+    # copy, never written into, so df may hold read-only snapshot maps; df must not be shared
+    for col, kind in schema.items():
+        if kind.startswith('cat:'):
+            codes = df[col].cat.codes.to_numpy().copy()
+            codes[positions] = rows[col].cat.codes.to_numpy()
+            df[col] = pd.Categorical.from_codes(codes, dtype=interned(kind).dtype)
+        else:
+            values = df[col].to_numpy().copy()
+            values[positions] = rows[col].to_numpy()
+            df[col] = values
+
+
+def first_row(df):
+    # The first row as a dict. Use this rather than df.iloc[0]: gathering a row into one Series
+    # makes pandas hash the categories of every interned column, i.e. a whole ID space
+    return df.iloc[:1].to_dict('records')[0]
+
+
+def join_rows(left, right, left_on, right_on=None, how='left'):
+    # left.merge(right) on one key column. Interned keys of the same space are matched on
+    # their integer codes instead of comparing strings
+    right_on = right_on or left_on
+    if space_of(left[left_on]) is None or space_of(left[left_on]) != space_of(right[right_on]):
+        return left.merge(right, left_on=left_on, right_on=right_on, how=how)
+    left_key = left[left_on].cat.codes.to_numpy()
+    right_key = right[right_on].cat.codes.to_numpy()
+    if right_on == left_on:
+        right = right.drop(columns=right_on)
+    # Usually right has one row per key (users, jobs): then the codes index a lookup array and
+    # every left row finds its match in one step, with no hashing at all
+    position = np.full(max(left_key.max(initial=-1), right_key.max(initial=-1)) + 2, -1)
+    position[right_key] = np.arange(len(right))
+    if how in ('left', 'inner') and (position[right_key] == np.arange(len(right))).all() \
+            and not set(left.columns) & set(right.columns):
+        rows = position[left_key]
+        if how == 'inner':
+            left, rows = left[rows >= 0], rows[rows >= 0]
+        matched = right.reset_index(drop=True).reindex(rows).reset_index(drop=True)
+        return pd.concat([left.reset_index(drop=True), matched], axis=1)
+    return left.merge(right, left_on=left_key, right_on=right_key, how=how).drop(columns='key_0')
+
+
+def _latest(df, key):
+    # Collapse every key to its last version while keeping the position of its first one
+    if not df.duplicated(key, keep='last').any():
+        return df
+    order = df.loc[~df.duplicated(key), key]
+    latest = df.drop_duplicates(key, keep='last').set_index(key)
+    if len(key) > 1:
+        latest = latest.loc[pd.MultiIndex.from_frame(order)]
+    else:
+        latest = latest.loc[order[key[0]]]
+    return latest.reset_index()[list(df.columns)]
+
+
+def is_list_value(value):
+    return isinstance(value, (list, tuple, set, np.ndarray, pd.Series, pd.Index, pd.Categorical))
+
+
+# Conditions are keyword arguments: column=value for equality (a list-like value matches any
+# of its members) or column__op=value with one of these operators, e.g. date__ge='2025-01-01'
+OPERATORS = {'eq': operator.eq, 'ne': operator.ne, 'lt': operator.lt, 'le': operator.le,
+             'gt': operator.gt, 'ge': operator.ge}
+
+
+def parse_condition(field):
+    col, _, op = field.partition('__')
+    op = op or 'eq'
+    if op not in OPERATORS:
+        raise ValueError(f'Unknown operator in condition: {field}')
+    return col, op
+
+
+def select(df, where):
+    if not where:
+        return df
+    mask = None
+    for field, value in where.items():
+        col, op = parse_condition(field)
+        column = df[col]
+        if is_list_value(value) and op in ('eq', 'ne'):
+            m = column.isin(list(value))
+            if op == 'ne':
+                m = ~m
+        else:
+            if pd.api.types.is_datetime64_dtype(column):
+                # Text that is not a date matches nothing
+                try:
+                    value = pd.Timestamp(value)
+                except ValueError:
+                    value = pd.NaT
+            elif space_of(column) is not None and op not in ('eq', 'ne'):
+                # Interned values have no order of their own; compare the text
+                column = column.astype(str)
+            m = OPERATORS[op](column, value)
+        mask = m if mask is None else mask & m
+    return df[mask]
+
+
+def sort_rows(df, order_by=None, descending=False):
+    # Stable, so rows with equal values keep their insertion order
+    if not order_by:
+        return df.iloc[::-1] if descending else df
+    return df.sort_values(order_by, ascending=not descending, kind='stable',
+                          key=lambda column: column.astype(str) if space_of(column) is not None else column)
+
+
+def stack_rows(frames, schema):
+    # The rows of frames one after another. Most lookups match rows in only one of them, which
+    # is then returned as it is
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+    if not frames:
+        return coerce_types(pd.DataFrame(columns=list(schema)), schema)
+    return concat_rows(frames, schema)
+
+
+def page_rows(frames, schema, order_by=None, descending=False, limit=None, offset=0, ordered=False):
+    # One page of the rows of frames taken one after another, sorted, and the total number of
+    # rows. ordered: the frames cover consecutive ranges of order_by and come in the order
+    # asked for, so only the ones the page falls in are sorted
+    total = sum(map(len, frames))
+    if limit is None:
+        return sort_rows(stack_rows(frames, schema), order_by, descending), total
+    if order_by and not ordered:
+        if len(frames) > 1:
+            # The page is among the first offset + limit rows of each frame
+            frames = [sort_rows(frame, order_by, descending).iloc[:offset + limit] for frame in frames]
+        return sort_rows(stack_rows(frames, schema), order_by, descending).iloc[offset:offset + limit], total
+    if descending and not ordered:
+        frames = frames[::-1]
+    pieces = []
+    for frame in frames:
+        if limit > 0 and offset < len(frame):
+            if ordered:
+                piece = sort_rows(frame, order_by, descending).iloc[offset:offset + limit]
+            elif descending:
+                # Insertion order: slice first, so only the page is copied
+                stop = len(frame) - offset
+                piece = frame.iloc[max(stop - limit, 0):stop].iloc[::-1]
+            else:
+                piece = frame.iloc[offset:offset + limit]
+            pieces.append(piece)
+            limit -= len(piece)
+        offset = max(offset - len(frame), 0)
+    if not pieces:
+        return stack_rows(frames[:1], schema).iloc[:0], total
+    return stack_rows(pieces, schema), total
+
+
+def _format(value, kind):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ''
+    if kind in DATE_FORMATS and hasattr(value, 'strftime'):
+        return value.strftime(DATE_FORMATS[kind])
+    return value
+
+
+class Table:
+    def __init__(self, name, data_dir, part=None, lock=None):
+        # part: key of the partition of a PartitionedTable this file holds; the partitions
+        # share the lock of their table
+        self.name = name
+        self.part = part
+        self.schema = SCHEMAS[name]
+        self.columns = list(self.schema)
+        self.key = KEYS[name]
+        self.lock = lock or FileLock(meta_path(data_dir, f'{name}.lock'))
+        self._lock = threading.Lock()
+        self._df = None
+        self._sig = None
+        self._offset = 0
+        self._file_columns = self.columns
+        self._file_rows = 0
+        self._pending = []
+        if part is None:
+            self.path = table_path(data_dir, name)
+            self._snapshot_dir, self._snapshot_name = meta_path(data_dir, 'snapshots'), name
+        else:
+            self.path = os.path.join(data_dir, name, f'{part}.csv')
+            self._snapshot_dir, self._snapshot_name = os.path.join(meta_path(data_dir, 'snapshots'), name), part
+        self._snapshot_lock = FileLock(meta_path(data_dir, f'{name}.snapshot.lock'))
+        self._snapshot_rows = 0
+
+    def init(self):
+        directory = os.path.join(os.path.dirname(self.path), self.name)
+        if self.name in PARTITIONED and self.part is None and os.path.isdir(directory) \
+                and any(entry.endswith('.csv') for entry in os.listdir(directory)):
+            raise RuntimeError(f'{directory} holds partitions of {self.name}; run python partitions.py merge')
+        if not os.path.exists(self.path):
+            pd.DataFrame(columns=self.columns).to_csv(self.path, index=False)
+
+    def parts(self, where=None, descending=False):
+        # The files to read for rows matching where (see PartitionedTable)
+        return [self]
+
+    def place(self, rows):
+        # rows as (file, rows to write to it) pairs (see PartitionedTable)
+        return [(self, rows)]
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def version(self):
+        # Changes with every write to the file, by this process or any other
+        try:
+            return self._stat()
+        except FileNotFoundError:
+            return None
+
+    def _parse(self, data, header=True):
+        # Everything is read as text once and converted per the schema, so pandas never
+        # has to guess a column's type (phones and OTPs stay strings, blanks stay '')
+        if not data.strip():
+            df = pd.DataFrame(columns=self._file_columns, dtype=str)
+        elif header:
+            df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, na_filter=False)
+        else:
+            df = pd.read_csv(io.BytesIO(data), header=None, names=self._file_columns,
+                             dtype=str, keep_default_na=False, na_filter=False)
+        for col in self.columns:
+            if col not in df.columns:
+                df[col] = ''
+        return coerce_types(df[self.columns].copy(), self.schema)
+
+    def _fold(self, new):
+        self._file_rows += len(new)
+        new = _latest(new.reset_index(drop=True), self.key)
+        if not len(self._df):
+            self._df = new
+            return
+        if len(self.key) > 1:
+            self._df = _latest(concat_rows([self._df, new], self.schema), self.key)
+            return
+        # self._df holds one row per key already, so it is only scanned for the new rows' keys
+        # (hashing those, not the table's): new versions replace their row in place and new
+        # keys are added at the end
+        col = self.key[0]
+        keys, new_keys = self._df[col], new[col]
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            keys, new_keys = keys.cat.codes, new_keys.cat.codes
+        hits = np.flatnonzero(keys.isin(new_keys).to_numpy())
+        positions = np.full(len(new), -1)
+        positions[pd.Index(new_keys).get_indexer(keys.iloc[hits])] = hits
+        updated = positions >= 0
+        df = concat_rows([self._df, new[~updated]], self.schema)
+        if updated.any():
+            replace_rows(df, positions[updated], new[updated], self.schema)
+        self._df = df
+
+    def _refresh(self):
+        if self._pending:
+            frames = [rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows, columns=self.columns)
+                      for rows in self._pending]
+            new = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+            self._fold(coerce_types(new[self.columns].copy(), self.schema))
+            self._pending = []
+        sig = self._stat()
+        if sig == self._sig:
+            return
+        appended = self._df is not None and sig[0] == self._sig[0] and sig[1] > self._offset
+        if not appended and self._load_snapshot(sig):
+            # The snapshot covers a prefix of the file; parse whatever was appended after it
+            appended = True
+        if appended:
+            if sig[1] == self._offset:
+                self._sig = sig
+                return
+            # Same file, only grown: parse just the lines appended since the last read
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            # A writer in another process may be half way through a line; leave it for later
+            data = data[:data.rfind(b'\n') + 1]
+            start = time.perf_counter()
+            self._fold(self._parse(data, header=False))
+            record_parse(time.perf_counter() - start)
+            record_read(self.name, nbytes=len(data))
+            self._offset += len(data)
+        else:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            data = data[:data.rfind(b'\n') + 1 or len(data)]
+            header = data[:data.find(b'\n')].decode().strip()
+            self._file_columns = header.split(',') if header else self.columns
+            start = time.perf_counter()
+            df = self._parse(data)
+            record_parse(time.perf_counter() - start)
+            record_read(self.name, nbytes=len(data))
+            self._file_rows = len(df)
+            self._df = _latest(df, self.key)
+            self._offset = len(data)
+            self._snapshot_rows = 0
+        self._sig = sig
+        if self._file_rows >= SNAPSHOT_MIN_ROWS and \
+                self._file_rows - self._snapshot_rows > SNAPSHOT_STALE_RATIO * self._snapshot_rows:
+            self._save_snapshot()
+
+    def _load_snapshot(self, sig):
+        loaded = snapshots.load(self._snapshot_dir, self._snapshot_name, self.schema, interned)
+        if loaded is None:
+            return False
+        df, info = loaded
+        if info['ino'] != sig[0] or info['offset'] > sig[1]:
+            return False
+        # Snapshots made before DIGIT_TEXT was cleaned on load may still hold the float text
+        for col in DIGIT_TEXT.intersection(self.columns):
+            df[col] = digit_text(df[col])
+        check = bytes.fromhex(info['check'])
+        with open(self.path, 'rb') as f:
+            f.seek(info['offset'] - len(check))
+            if f.read(len(check)) != check:
+                return False
+        self._df = df
+        self._file_columns = info['file_columns']
+        self._file_rows = self._snapshot_rows = info['file_rows']
+        self._offset = info['offset']
+        return True
+
+    def _save_snapshot(self):
+        # Covers the file up to self._offset, which self._df reflects. A snapshot is only a
+        # cache, so failing to write one is not an error
+        self._snapshot_rows = self._file_rows
+        try:
+            with self._snapshot_lock, open(self.path, 'rb') as f:
+                f.seek(max(self._offset - SNAPSHOT_CHECK_BYTES, 0))
+                check = f.read(self._offset - f.tell())
+                info = {'ino': self._sig[0], 'offset': self._offset, 'check': check.hex(),
+                        'file_rows': self._file_rows, 'file_columns': self._file_columns}
+                snapshots.save(self._snapshot_dir, self._snapshot_name, self._df, self.schema, info)
+        except OSError:
+            pass
+
+    def read(self):
+        with self._lock:
+            self._refresh()
+            return self._df
+
+    def write(self, df):
+        df = coerce_types(df[self.columns].reset_index(drop=True), self.schema)
+        with self.lock, self._lock:
+            # Rewrites go to a temp file that is renamed over the table, so readers never see
+            # a half-written file and can tell a rewrite (new inode) from an append
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=f'.{self.name}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', newline='') as f:
+                    # mkstemp makes the file private; it takes the mode of the file it replaces
+                    os.fchmod(f.fileno(), _file_mode(self.path))
+                    format_rows(df).to_csv(f, index=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = f.tell()
+                os.replace(tmp, self.path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self._df = df
+            self._file_columns = self.columns
+            self._file_rows = len(df)
+            self._pending = []
+            self._sig = self._stat()
+            self._offset = self._sig[1]
+            self._snapshot_rows = 0
+            if len(df) >= SNAPSHOT_MIN_ROWS:
+                self._save_snapshot()
+        record_write(self.name, len(df), size)
+
+    def append(self, rows):
+        # rows is a list of dicts or, for bulk inserts, a DataFrame
+        buf = io.StringIO()
+        if isinstance(rows, pd.DataFrame):
+            format_rows(rows.reindex(columns=self._file_columns)).to_csv(buf, header=False, index=False,
+                                                                          lineterminator='\n')
+        else:
+            writer = csv.writer(buf, lineterminator='\n')
+            for row in rows:
+                writer.writerow([_format(row.get(col), self.schema.get(col)) for col in self._file_columns])
+        data = buf.getvalue().encode()
+        with self.lock, self._lock:
+            current = self._df is not None and self._stat() == self._sig
+            with open(self.path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        data = b'\n' + data
+                # One write call, so a reader never sees rows from two writers interleaved
+                f.write(data)
+            record_write(self.name, len(rows), len(data))
+            if current:
+                # Our own rows are known already; fold them in on the next read instead of
+                # parsing them back out of the file
+                self._pending.append(rows)
+                self._sig = self._stat()
+                self._offset = self._sig[1]
+
+    def stale_rows(self):
+        with self._lock:
+            self._refresh()
+            return self._file_rows - len(self._df)
+
+    def compact(self):
+        with self.lock:
+            self.write(self.read())
+
+    def rows_since(self, cursor):
+        # Rows appended after cursor (a row count) and the cursor to pass next time; only
+        # meaningful for insert-only tables such as attendance
+        df = self.read()
+        return df.iloc[cursor:], len(df)
+
+
+class PartitionedTable:
+    # A PARTITIONED table kept as one CSV file per period (month or year) of its date column,
+    # <data_dir>/<name>/<key>.csv with keys such as 2025-01, each cached by a Table of its own.
+    # A condition on the date column limits a lookup to the partitions it can match, so today's
+    # rows are found in this month's file however much history there is. A partition is closed
+    # CLOSE_AFTER_DAYS after its period ends: rows dated in it are refused from then on, and the
+    # first write of a day that finds such a partition still open compacts it, makes its file
+    # read-only and records its row count in the index, .meta/<name>.partitions.json. The cursor
+    # of rows_since maps partition keys to row counts, so closed partitions that a cursor has
+    # seen in full are never read again
+    def __init__(self, name, data_dir, period):
+        self.name = name
+        self.schema = SCHEMAS[name]
+        self.columns = list(self.schema)
+        self.column = PARTITIONED[name]
+        self.period = period
+        self.data_dir = data_dir
+        self.directory = os.path.join(data_dir, name)
+        self.lock = FileLock(meta_path(data_dir, f'{name}.lock'))
+        self.index_path = meta_path(data_dir, f'{name}.partitions.json')
+        self._lock = threading.Lock()
+        self._parts = {}
+        self._read = None
+        self._checked = None
+
+    def init(self):
+        path = table_path(self.data_dir, self.name)
+        if has_rows(path):
+            raise RuntimeError(f'{path} has rows outside the partitions; run python partitions.py split')
+        index = self._load_index()
+        if index['period'] != self.period:
+            raise RuntimeError(f'{self.directory} is partitioned by {index["period"]}; '
+                               f'run python partitions.py merge first')
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.index_path):
+            with self.lock:
+                self._save_index(index)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        return {'period': self.period, 'closed': {}, **index}
+
+    def _save_index(self, index):
+        with open(f'{self.index_path}.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+
+    def keys(self):
+        # Keys of the partitions, in date order with UNDATED last
+        try:
+            entries = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        keys = [entry[:-4] for entry in entries if entry.endswith('.csv') and not entry.startswith('.')]
+        return sorted(keys, key=lambda key: (key == UNDATED, key))
+
+    def version(self):
+        return tuple((key, self.part(key).version()) for key in self.keys())
+
+    def part(self, key):
+        part = self._parts.get(key)
+        if part is None:
+            with self._lock:
+                part = self._parts.setdefault(key, Table(self.name, self.data_dir, key, self.lock))
+        return part
+
+    def parts(self, where=None, descending=False):
+        # The partitions that can hold rows matching where, in date order or, descending, in
+        # reverse date order (UNDATED last either way). Date conditions only ever match dates
+        keys = self.keys()
+        for field, value in (where or {}).items():
+            col, op = parse_condition(field)
+            if col != self.column or op == 'ne':
+                continue
+            values = set(partition_keys(self.period, value) if is_list_value(value)
+                         else [partition_key(self.period, value)]) - {UNDATED}
+            if op == 'eq':
+                keys = [key for key in keys if key in values]
+            elif not values:
+                keys = []
+            elif op in ('ge', 'gt'):
+                keys = [key for key in keys if key != UNDATED and key >= min(values)]
+            else:
+                keys = [key for key in keys if key != UNDATED and key <= max(values)]
+        if descending:
+            keys = [key for key in keys[::-1] if key != UNDATED] + [key for key in keys if key == UNDATED]
+        return [self.part(key) for key in keys]
+
+    def place(self, rows):
+        # rows (a list of dicts or a DataFrame) as (partition, rows) pairs, creating the files of
+        # new partitions. Raises ValueError if any of them is dated in a closed period
+        if isinstance(rows, pd.DataFrame):
+            keys = partition_keys(self.period, rows[self.column])
+        else:
+            keys = np.array([partition_key(self.period, row.get(self.column)) for row in rows], dtype=object)
+        unique = list(pd.unique(keys))
+        closed = [key for key in unique if period_closed(self.period, key)]
+        if closed:
+            raise ValueError(f'{self.name} for {", ".join(closed)} is closed')
+        self._close_due()
+        if len(unique) == 1:
+            return [(self._create(unique[0]), rows)]
+        placed = []
+        for key in unique:
+            mask = keys == key
+            placed.append((self._create(key), rows[mask] if isinstance(rows, pd.DataFrame)
+                           else [row for row, m in zip(rows, mask) if m]))
+        return placed
+
+    def _create(self, key):
+        part = self.part(key)
+        if not os.path.exists(part.path):
+            with self.lock:
+                if not os.path.exists(part.path):
+                    os.makedirs(self.directory, exist_ok=True)
+                    pd.DataFrame(columns=self.columns).to_csv(f'{part.path}.tmp', index=False)
+                    os.replace(f'{part.path}.tmp', part.path)
+        return part
+
+    def _remove(self, key):
+        part = self.part(key)
+        if os.path.exists(part.path):
+            os.remove(part.path)
+        snapshots.remove(part._snapshot_dir, key)
+        with self._lock:
+            self._parts.pop(key, None)
+
+    def _close_due(self):
+        # Closes the partitions whose period has ended; checked at most once a day per process
+        today = time.strftime('%Y-%m-%d')
+        if self._checked == today:
+            return
+        with self.lock:
+            index = self._load_index()
+            due = [key for key in self.keys() if key not in index['closed'] and period_closed(self.period, key)]
+            for key in due:
+                part = self.part(key)
+                if part.stale_rows():
+                    part.compact()
+                index['closed'][key] = len(part.read())
+                os.chmod(part.path, 0o444)
+            if due:
+                self._save_index(index)
+        self._checked = today
+
+    def read(self):
+        # Every partition's rows, joined once for as long as none of them changes
+        frames = [part.read() for part in self.parts()]
+        with self._lock:
+            if self._read is None or len(self._read[0]) != len(frames) \
+                    or any(old is not new for old, new in zip(self._read[0], frames)):
+                self._read = (frames, stack_rows(frames, self.schema))
+            return self._read[1]
+
+    def write(self, df):
+        # Replaces the whole table, closed partitions included; they are closed again after
+        keys = partition_keys(self.period, df[self.column])
+        unique = list(pd.unique(keys))
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for key in set(self.keys()).difference(unique):
+                self._remove(key)
+            for key in unique:
+                self.part(key).write(df[keys == key])
+            self._save_index({**self._load_index(), 'closed': {}})
+            self._checked = None
+            self._close_due()
+
+    def stale_rows(self):
+        closed = self._load_index()['closed']
+        return sum(self.part(key).stale_rows() for key in self.keys() if key not in closed)
+
+    def compact(self):
+        with self.lock:
+            closed = self._load_index()['closed']
+            for key in self.keys():
+                if key not in closed and self.part(key).stale_rows():
+                    self.part(key).compact()
+
+    def rows_since(self, cursor):
+        if not isinstance(cursor, dict):
+            if cursor:
+                raise ValueError('Row-count cursors of an unpartitioned table do not apply to partitions')
+            cursor = {}
+        closed = self._load_index()['closed']
+        frames, end = [], {}
+        for key in self.keys():
+            seen = cursor.get(key, 0)
+            if closed.get(key) == seen:
+                end[key] = seen
+                continue
+            df = self.part(key).read()
+            frames.append(df.iloc[seen:])
+            end[key] = len(df)
+        return stack_rows(frames, self.schema), end
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class CounterLog:
+    # Counters kept as an append-only log of "key<TAB>delta" lines and summed in memory, so
+    # an increment is one small append and a read only folds in lines added since the last
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+        self._mutex = threading.Lock()
+        self._values = {}
+        self._sig = None
+        self._offset = 0
+        self._lines = 0
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._values, self._sig, self._offset, self._lines = {}, None, 0, 0
+            return
+        sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if sig == self._sig:
+            return
+        if self._sig is None or st.st_ino != self._sig[0] or st.st_size < self._offset:
+            self._values, self._offset, self._lines = {}, 0, 0
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        values = self._values
+        for line in data.decode().splitlines():
+            key, _, delta = line.rpartition('\t')
+            values[key] = values.get(key, 0) + _number(delta)
+        self._lines += data.count(b'\n')
+        self._offset += len(data)
+        self._sig = sig
+
+    def _rewrite(self, values):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(''.join(f'{key}\t{value}\n' for key, value in values.items() if value))
+        os.replace(tmp, self.path)
+        self._sig = None
+        self._refresh()
+
+    def get(self, keys):
+        with self._mutex:
+            self._refresh()
+            return {key: self._values.get(key, 0) for key in keys}
+
+    def add(self, deltas):
+        data = ''.join(f'{key}\t{delta}\n' for key, delta in deltas.items() if delta).encode()
+        if not data:
+            return
+        with self.lock, self._mutex:
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            self._refresh()
+            if self._lines > COMPACT_MIN_STALE and self._lines > 2 * len(self._values):
+                self._rewrite(self._values)
+
+    def reset(self, values):
+        with self.lock, self._mutex:
+            self._rewrite(values)
+
+
+class CSVBackend:
+    # One CSV file per table under data_dir, each cached in memory by its Table. With partitions
+    # ('month' or 'year') the PARTITIONED tables are kept one file per period instead
+    name = 'csv'
+
+    def __init__(self, data_dir=DATA_DIR, partitions=None):
+        if partitions is not None and partitions not in PERIODS:
+            raise ValueError(f'Unknown partition period: {partitions}')
+        self.data_dir = data_dir
+        self.partitions = partitions
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+        self.counters = CounterLog(meta_path(data_dir, 'counters.log'), FileLock(meta_path(data_dir, 'counters.lock')))
+
+    def table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            with self._tables_lock:
+                table = self._tables.setdefault(name, PartitionedTable(name, self.data_dir, self.partitions)
+                                                if self.partitions and name in PARTITIONED
+                                                else Table(name, self.data_dir))
+        return table
+
+    def init(self, names=SCHEMAS):
+        os.makedirs(self.data_dir, exist_ok=True)
+        for name in names:
+            self.table(name).init()
+
+    def read(self, name):
+        df = self.table(name).read()
+        record_read(name, len(df))
+        return df
+
+    def _frames(self, name, where, descending=False):
+        # The rows matching where from each file that can hold any: the table's own, or the
+        # partitions picked by its date conditions
+        frames = []
+        for part in self.table(name).parts(where, descending):
+            df = part.read()
+            record_read(name, len(df))
+            frames.append(select(df, where))
+        return frames
+
+    def find(self, name, **where):
+        return stack_rows(self._frames(name, where), SCHEMAS[name])
+
+    def count(self, name, **where):
+        return sum(map(len, self._frames(name, where)))
+
+    def sum(self, name, column, **where):
+        return sum(frame[column].sum() for frame in self._frames(name, where))
+
+    def write(self, name, df):
+        self.table(name).write(df)
+
+    def append(self, name, rows):
+        table = self.table(name)
+        with table.lock:
+            for part, rows in table.place(rows):
+                part.append(rows)
+
+    def update(self, name, rows):
+        # On a partitioned table the new version of a row goes to the partition of its date, so
+        # a row has to keep its date
+        table = self.table(name)
+        with table.lock:
+            for part, rows in table.place(rows):
+                part.append(rows)
+                stale = part.stale_rows()
+                if stale > COMPACT_MIN_STALE and stale > COMPACT_STALE_RATIO * len(part.read()):
+                    part.compact()
+
+    @contextmanager
+    def locked(self, *names, **where):
+        acquired = []
+        try:
+            for name in sorted(set(names)):
+                lock = self.table(name).lock
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def next_ids(self, name, count):
+        with FileLock(meta_path(self.data_dir, f'{name}.seq.lock')):
+            path = meta_path(self.data_dir, f'{name}.seq')
+            try:
+                with open(path) as f:
+                    last = int(f.read().strip())
+            except (OSError, ValueError):
+                last = max_id(self.read(name)[KEYS[name][0]])
+            with open(f'{path}.tmp', 'w') as f:
+                f.write(str(last + count))
+            os.replace(f'{path}.tmp', path)
+            return range(last + 1, last + count + 1)
+
+    def query(self, name, order_by=None, descending=False, limit=None, offset=0, **where):
+        # Partitions are in date order, so a page sorted by their date column only sorts the
+        # partitions it falls in
+        table = self.table(name)
+        ordered = isinstance(table, PartitionedTable) and order_by == table.column
+        frames = self._frames(name, where, descending and ordered)
+        return page_rows(frames, SCHEMAS[name], order_by, descending, limit, offset, ordered)
+
+    def iter_chunks(self, name, chunk_size, order_by=None, descending=False, **where):
+        table = self.table(name)
+        ordered = isinstance(table, PartitionedTable) and order_by == table.column
+        if order_by and not ordered:
+            frames = [self.find(name, **where)]
+        else:
+            frames = self._frames(name, where, descending and ordered)
+            if descending and not ordered:
+                frames = frames[::-1]
+        for frame in frames:
+            frame = sort_rows(frame, order_by, descending)
+            for start in range(0, len(frame), chunk_size):
+                yield frame.iloc[start:start + chunk_size]
+
+    def iter_csv(self, name, chunk_size, **where):
+        return csv_chunks(self.iter_chunks(name, chunk_size, **where))
+
+    def rows_since(self, name, cursor):
+        # Rows appended after cursor and the cursor to pass next time (see Table.rows_since and
+        # PartitionedTable)
+        df, cursor = self.table(name).rows_since(cursor)
+        record_read(name, len(df))
+        return df, cursor
+
+    def versions(self, names):
+        # A token per table that changes whenever the table is written
+        return {name: self.table(name).version() for name in names}
+
+    def get_state(self, key, default=None):
+        try:
+            with open(meta_path(self.data_dir, 'state.json')) as f:
+                return json.load(f).get(key, default)
+        except (OSError, ValueError):
+            return default
+
+    def set_state(self, key, value):
+        path = meta_path(self.data_dir, 'state.json')
+        with FileLock(meta_path(self.data_dir, 'state.lock')):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            state[key] = value
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(f'{path}.tmp', path)
+
+    def get_counters(self, keys):
+        return self.counters.get(keys)
+
+    def add_counters(self, deltas):
+        self.counters.add(deltas)
+
+    def reset_counters(self, values):
+        self.counters.reset(values)
+
+    def compact(self, names=SCHEMAS):
+        for name in names:
+            with self.locked(name):
+                if self.table(name).stale_rows():
+                    self.table(name).compact()
+
+
+def csv_chunks(chunks):
+    # Frames as CSV text without the header, the way exports stream them
+    for chunk in chunks:
+        yield format_rows(chunk).to_csv(index=False, header=False)
+
+
+def max_id(ids):
+    nums = [int(m.group()) for m in map(re.compile(r'\d+$').search, ids) if m]
+    return max(nums, default=0)
+
+
+_backend = None
+# Backend of the current thread inside using(), e.g. one district's shard
+_scoped = contextvars.ContextVar('storage_backend', default=None)
+
+
+def configure(backend='csv', data_dir=DATA_DIR, **options):
+    global _backend
+    if backend == 'csv':
+        _backend = CSVBackend(data_dir, **options)
+    elif backend == 'sqlite':
+        from sqlite_store import SQLiteBackend
+        _backend = SQLiteBackend(data_dir, **options)
+    elif backend == 'sharded':
+        from shards import ShardedBackend
+        _backend = ShardedBackend(data_dir, **options)
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    return _backend
+
+
+def get_backend():
+    scoped = _scoped.get()
+    if scoped is not None:
+        return scoped
+    if _backend is None:
+        configure()
+    return _backend
+
+
+@contextmanager
+def using(backend):
+    # Runs the block against another backend; only this thread sees the change
+    token = _scoped.set(backend)
+    try:
+        yield backend
+    finally:
+        _scoped.reset(token)
+
+
+def _reset_locks():
+    # A fork copies these locks as they are, possibly held by a thread the child does not have
+    global _spaces_lock
+    _spaces_lock = threading.Lock()
+    for space in _spaces.values():
+        space._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_locks)
+
+
+def init_tables():
+    get_backend().init()
+
+
+@timed
+def read_table(name):
+    # The returned frame may be shared between requests; copy it before modifying
+    return get_backend().read(name)
+
+
+@timed
+def find_rows(name, **where):
+    return get_backend().find(name, **where)
+
+
+@timed
+def count_rows(name, **where):
+    return get_backend().count(name, **where)
+
+
+@timed
+def sum_column(name, column, **where):
+    return get_backend().sum(name, column, **where)
+
+
+@timed
+def query_rows(name, order_by=None, descending=False, limit=None, offset=0, **where):
+    # One page of the matching rows and the total number of matches
+    return get_backend().query(name, order_by, descending, limit, offset, **where)
+
+
+def iter_rows(name, chunk_size=10000, order_by=None, descending=False, **where):
+    # The matching rows as a sequence of frames, for streaming large results
+    return get_backend().iter_chunks(name, chunk_size, order_by, descending, **where)
+
+
+def iter_csv(name, chunk_size=10000, **where):
+    # The matching rows as CSV text without the header, a chunk at a time
+    return get_backend().iter_csv(name, chunk_size, **where)
+
+
+def fan_out(func, *args, progress=None):
+    # Calls func(*args) once per district shard of the sharded layout, in parallel worker
+    # processes that each have their shard as the backend, and returns the results in district
+    # order; progress(done, total) counts shards. Other backends are a single shard
+    backend = get_backend()
+    if backend.name != 'sharded':
+        return [func(*args)]
+    return backend.fan_out(func, *args, progress=progress)
+
+
+@timed
+def write_table(name, df):
+    get_backend().write(name, df)
+
+
+@timed
+def append_rows(name, rows):
+    if len(rows):
+        get_backend().append(name, rows)
+
+
+@timed
+def update_rows(name, rows):
+    # rows are complete new versions of existing rows, matched on the table's key
+    if len(rows):
+        get_backend().update(name, rows)
+
+
+def locked(*names, **where):
+    # Holds the write lock of every named table; take all the tables a read-check-write
+    # sequence needs in one call so they are always acquired in the same order. where, in
+    # find_rows form, says which rows the sequence reads and writes (job_id=..., district=...,
+    # or the rows it updates); the sharded layout then only locks the shards those are in.
+    # Locks taken inside the block must be covered by it
+    return get_backend().locked(*names, **where)
+
+
+def named_lock(name):
+    # A lock of its own, shared by every process using the data set, for checks that no table
+    # lock covers (such as the uniqueness of a new user's email across district shards)
+    backend = get_backend()
+    path = meta_path(backend.data_dir, f'{name}.lock')
+    lock = _named_locks.get(path)
+    if lock is None:
+        with _spaces_lock:
+            lock = _named_locks.setdefault(path, FileLock(path))
+    return lock
+
+
+@timed
+def next_ids(name, count=1):
+    # Numbers come from a persisted per-table counter, so two processes can never hand out
+    # the same ID; the counter is seeded from the highest ID already in the table
+    return get_backend().next_ids(name, count)
+
+
+def next_id(name):
+    return next_ids(name)[0]
+
+
+@timed
+def rows_since(name, cursor=0):
+    return get_backend().rows_since(name, cursor)
+
+
+@timed
+def get_state(key, default=None):
+    # Small persisted values such as high-water marks of incremental jobs
+    return get_backend().get_state(key, default)
+
+
+@timed
+def set_state(key, value):
+    get_backend().set_state(key, value)
+
+
+@timed
+def get_counters(*keys):
+    # Current value of each counter key (0 for keys never incremented)
+    return get_backend().get_counters(keys)
+
+
+@timed
+def add_counters(deltas):
+    get_backend().add_counters(deltas)
+
+
+@timed
+def reset_counters(values):
+    # Replaces every counter with the given values, e.g. after rebuilding them from the tables
+    get_backend().reset_counters(values)
+
+
+@timed
+def table_versions(*names):
+    # Tokens that compare equal only while the tables are unwritten, by any process; for
+    # telling whether something built from the tables is still current
+    return get_backend().versions(names)
+
+
+def compact_tables():
+    get_backend().compact()
+
+
+def is_closed(name, date):
+    # Whether rows of name dated date would go to a closed partition, and so can not be written
+    period = getattr(get_backend(), 'partitions', None)
+    return name in PARTITIONED and period is not None and period_closed(period, partition_key(period, date))
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from storage import find_rows, append_rows, update_rows, locked, next_id, first_row
+from allocation import allocate_jobs
+from payroll import calculate_wages
+
+# Background tasks. The tasks table is the queue: enqueue() records a task as queued and hands
+# it to a thread pool in this process, and the task's row follows it through running to done
+# or failed, with its progress. A task left queued or running by a process that has exited is
+# run again by recover() at startup, so every handler must be safe to run twice.
+
+# Handlers by kind; each takes its task's params as keyword arguments plus progress(done, total)
+HANDLERS = {
+    'allocate': allocate_jobs,
+    'payroll': calculate_wages,
+}
+
+ACTIVE = ['queued', 'running']
+# A running task's progress is written to its row at most this often (seconds)
+PROGRESS_INTERVAL = 0.5
+
+log = logging.getLogger('portal.tasks')
+
+_pool = None
+_futures = set()
+_futures_lock = threading.Lock()
+
+
+def _owner():
+    return f'{os.uname().nodename}:{os.getpid()}'
+
+
+def _orphaned(owner):
+    # The process that owns the task is gone (or is this one, restarted under the same pid)
+    host, _, pid = owner.rpartition(':')
+    if host != os.uname().nodename or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def configure(workers=2):
+    # workers=0 runs every task in the thread that enqueues it, before enqueue returns
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = ThreadPoolExecutor(workers, thread_name_prefix='portal-task') if workers else None
+
+
+def get_task(task_id):
+    rows = find_rows('tasks', task_id=task_id)
+    return first_row(rows) if not rows.empty else None
+
+
+def enqueue(kind, created_by='', **params):
+    # Returns the task's ID. A task of the same kind and params that is still queued or running
+    # is returned instead of adding a second one
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown task kind: {kind}')
+    params = json.dumps(params, sort_keys=True)
+    with locked('tasks'):
+        active = find_rows('tasks', kind=kind, params=params, status=ACTIVE)
+        if not active.empty:
+            return active['task_id'].iloc[-1]
+        task_id = f"TASK{str(next_id('tasks')).zfill(5)}"
+        append_rows('tasks', [{
+            'task_id': task_id,
+            'kind': kind,
+            'params': params,
+            'status': 'queued',
+            'progress': 0,
+            'total': 0,
+            'result': '',
+            'error': '',
+            'owner': _owner(),
+            'created_by': created_by,
+            'created_at': _now(),
+            'started_at': '',
+            'finished_at': '',
+        }])
+    _submit(task_id)
+    return task_id
+
+
+def _submit(task_id):
+    if _pool is None:
+        _run(task_id)
+        return
+    future = _pool.submit(_run, task_id)
+    with _futures_lock:
+        _futures.add(future)
+    future.add_done_callback(_discard)
+
+
+def _discard(future):
+    with _futures_lock:
+        _futures.discard(future)
+
+
+def _update(task, **changes):
+    task.update(changes)
+    update_rows('tasks', [task])
+
+
+def _run(task_id):
+    with locked('tasks'):
+        task = get_task(task_id)
+        if task is None or task['status'] not in ACTIVE or task['owner'] != _owner():
+            return
+        _update(task, status='running', started_at=_now(), error='')
+    last = [time.monotonic()]
+
+    def progress(done, total):
+        # Kept on the task and saved with its final status; short tasks never write it separately
+        task.update(progress=int(done), total=int(total))
+        now = time.monotonic()
+        if now - last[0] >= PROGRESS_INTERVAL:
+            last[0] = now
+            with locked('tasks'):
+                _update(task)
+
+    try:
+        result = HANDLERS[task['kind']](progress=progress, **json.loads(task['params']))
+    except Exception as e:
+        log.exception('Task %s (%s) failed', task_id, task['kind'])
+        with locked('tasks'):
+            _update(task, status='failed', error=str(e), finished_at=_now())
+        return
+    with locked('tasks'):
+        _update(task, status='done', result='' if result is None else str(result), finished_at=_now())
+
+
+def recover():
+    # Takes over the tasks whose process died before finishing them and runs them again
+    with locked('tasks'):
+        tasks = find_rows('tasks', status=ACTIVE)
+        orphaned = [row for row in tasks.to_dict('records') if _orphaned(row['owner'])]
+        for task in orphaned:
+            _update(task, status='queued', owner=_owner())
+    for task in orphaned:
+        _submit(task['task_id'])
+    return len(orphaned)
+
+
+def join(timeout=None):
+    # Waits until the tasks submitted in this process have finished
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _futures_lock:
+            pending = list(_futures)
+        if not pending:
+            return True
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return False
+        wait(pending, remaining)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import storage
+
+BACKENDS = ['csv', 'sqlite', 'sharded']
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # A copy of the sample data, without the snapshots, state and databases made from it
+    path = tmp_path / 'data'
+    shutil.copytree(os.path.join(APP_DIR, 'data'), path, ignore=shutil.ignore_patterns('.meta', 'portal.db*'))
+    return str(path)
+
+
+def convert(backend, data_dir):
+    # Turns a copy of the CSV data set into the layout backend reads
+    if backend == 'sqlite':
+        import sqlite_store
+        sqlite_store.import_csv(data_dir)
+    elif backend == 'sharded':
+        import shards
+        shards.split(data_dir)
+
+
+def open_backend(backend, data_dir):
+    # Configures storage for backend in this process; the sharded layout runs shards in-process
+    storage.configure(backend, data_dir, **({'workers': 0} if backend == 'sharded' else {}))
+    storage.init_tables()
+    return storage.get_backend()
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, data_dir):
+    convert(request.param, data_dir)
+    yield open_backend(request.param, data_dir)
+    storage.configure()
+
+
+@pytest.fixture
+def client(data_dir, monkeypatch):
+    # The app on a copy of the data set (its paths are relative to the working directory), with
+    # background tasks run inside the request
+    monkeypatch.chdir(os.path.dirname(data_dir))
+    monkeypatch.setenv('PORTAL_TASK_WORKERS', '0')
+    import app as portal
+    portal.app.config.update(TESTING=True, TASK_WORKERS=0)
+    portal.init_data()
+    yield portal.app.test_client()
+    storage.configure()
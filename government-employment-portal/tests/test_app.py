@@ -0,0 +1,19 @@
+def sign_in(client, user_id, role):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['role'] = role
+
+
+def test_page_links_with_a_query_parameter_named_like_the_path(client):
+    sign_in(client, 'GOV0003', 'government')
+    response = client.get('/government/allocations/JOB0001?job_id=other&page=1')
+    assert response.status_code == 200
+
+
+def test_decorated_functions_keep_their_identity(client):
+    import app as portal
+    import storage
+    assert portal.view_allocations.__wrapped__.__name__ == 'view_allocations'
+    assert portal.view_allocations.__qualname__ == 'view_allocations'
+    assert storage.find_rows.__module__ == 'storage'
+    assert storage.find_rows.__qualname__ == 'find_rows'
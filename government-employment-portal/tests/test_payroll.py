@@ -0,0 +1,96 @@
+import pytest
+import counters
+import payroll
+import storage
+
+DAILY_WAGE = 300.0
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def jobs(backend):
+    storage.append_rows('jobs', [{'job_id': job_id, 'district': district, 'daily_wage': DAILY_WAGE,
+                                  'status': 'Active'} for job_id, district in [('JOB0001', 'Banglore'),
+                                                                               ('JOB0002', 'Mysore')]])
+    counters.ensure_counters(force=True)
+    return backend
+
+
+def mark(*pairs, date='2026-01-05'):
+    numbers = storage.next_ids('attendance', len(pairs))
+    storage.append_rows('attendance', [{
+        'attendance_id': f'ATT{str(number).zfill(5)}', 'job_id': job_id, 'worker_id': worker_id,
+        'supervisor_id': 'SUP0002', 'date': date, 'status': 'Present', 'marked_at': f'{date} 10:00:00',
+    } for number, (worker_id, job_id) in zip(numbers, pairs)])
+
+
+def check():
+    # Every pair's Present days are in its Pending row exactly once
+    present = storage.find_rows('attendance', status='Present')
+    expected = present.groupby(['worker_id', 'job_id'], observed=True).size()
+    wages = storage.read_table('wages')
+    pending = wages[wages['payment_status'] == 'Pending']
+    paid = pending.groupby(['worker_id', 'job_id'], observed=True)['days_present'].sum()
+    assert paid[paid > 0].sort_index().to_dict() == expected.sort_index().to_dict()
+    assert (pending['total_wage'] == pending['days_present'] * DAILY_WAGE).all()
+    assert counters.get_counters('wages.total')['wages.total'] == pytest.approx(wages['total_wage'].sum())
+
+
+def crash_in(monkeypatch, name, when=lambda *args: True):
+    real = getattr(payroll, name)
+
+    def crashing(*args):
+        if when(*args):
+            raise Crash(name)
+        return real(*args)
+    monkeypatch.setattr(payroll, name, crashing)
+
+
+def test_a_second_run_counts_nothing_again(jobs):
+    mark(('WOR0001', 'JOB0001'), ('WOR0004', 'JOB0001'), ('WOR0005', 'JOB0002'))
+    mark(('WOR0001', 'JOB0001'), date='2026-01-06')
+    assert payroll.calculate_wages() == 3
+    check()
+    assert payroll.calculate_wages() is None
+    check()
+    mark(('WOR0001', 'JOB0001'), ('WOR0006', 'JOB0002'), date='2026-01-07')
+    assert payroll.calculate_wages() == 2
+    assert payroll.calculate_wages() is None
+    check()
+
+
+@pytest.mark.parametrize('step', ['set_state', 'update_rows', 'append_rows'])
+def test_a_run_interrupted_before_saving_its_cursor_counts_no_day_twice(jobs, monkeypatch, step):
+    mark(('WOR0001', 'JOB0001'), ('WOR0004', 'JOB0002'))
+    payroll.calculate_wages()
+    # Existing rows are updated before new ones are appended; the cursor is saved last
+    mark(('WOR0001', 'JOB0001'), ('WOR0004', 'JOB0002'), ('WOR0005', 'JOB0001'), ('WOR0006', 'JOB0002'),
+         date='2026-01-06')
+    if step == 'set_state':
+        crash_in(monkeypatch, step, lambda key, value: key == payroll.CURSOR_KEY)
+    else:
+        crash_in(monkeypatch, step)
+    with pytest.raises(Crash):
+        payroll.calculate_wages()
+    monkeypatch.undo()
+    payroll.calculate_wages()
+    check()
+    assert payroll.calculate_wages() is None
+    check()
+
+
+def test_runs_interrupted_twice_from_the_same_cursor(jobs, monkeypatch):
+    mark(('WOR0001', 'JOB0001'))
+    payroll.calculate_wages()
+    mark(('WOR0001', 'JOB0001'), ('WOR0005', 'JOB0001'), date='2026-01-06')
+    crash_in(monkeypatch, 'set_state', lambda key, value: key == payroll.CURSOR_KEY)
+    for _ in range(2):
+        with pytest.raises(Crash):
+            payroll.calculate_wages()
+        mark(('WOR0001', 'JOB0001'), date='2026-01-07')
+    monkeypatch.undo()
+    payroll.calculate_wages()
+    check()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import pandas as pd
+import pytest
+import storage
+import shards
+from conftest import open_backend
+
+ROUNDS = 60
+
+
+def _sharded_without_blank_district(data_dir):
+    # Users without a district would make the '' shard; here it is only made by the writes
+    path = os.path.join(data_dir, 'users.csv')
+    users = pd.read_csv(path, dtype=str, keep_default_na=False)
+    users[users['district'] != ''].to_csv(path, index=False)
+    shards.split(data_dir)
+    assert '' not in shards.ShardedBackend(data_dir, workers=0).districts()
+
+
+def _mark_unknown_job(data_dir, where, results):
+    open_backend('sharded', data_dir)
+    refused = 0
+    for _ in range(ROUNDS):
+        try:
+            with storage.locked('attendance', 'users', **where):
+                number = storage.next_id('attendance')
+                storage.append_rows('attendance', [{
+                    'attendance_id': f'ATT{str(number).zfill(5)}', 'job_id': 'JOBX', 'worker_id': 'WOR0001',
+                    'supervisor_id': 'SUP0002', 'date': '2026-01-01', 'status': 'Present',
+                    'marked_at': '2026-01-01 10:00:00',
+                }])
+                worker = storage.find_rows('users', user_id='WOR0001')
+                storage.update_rows('users', [storage.first_row(worker)])
+        except RuntimeError:
+            refused += 1
+    results.put(refused)
+
+
+def _run(data_dir, where, processes=6):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_mark_unknown_job, args=(data_dir, where, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    alive = [worker for worker in workers if worker.is_alive()]
+    for worker in alive:
+        worker.kill()
+    assert not alive, 'writers deadlocked'
+    return [results.get(timeout=5) for _ in workers]
+
+
+@pytest.fixture
+def sharded_dir(data_dir):
+    _sharded_without_blank_district(data_dir)
+    yield data_dir
+    storage.configure()
+
+
+def test_writes_to_a_new_shard_under_a_covering_lock(sharded_dir):
+    # The job is unknown, so its rows go to the '' shard, made and locked by locked() itself
+    assert _run(sharded_dir, {'job_id': 'JOBX'}) == [0] * 6
+    open_backend('sharded', sharded_dir)
+    marked = storage.find_rows('attendance', job_id='JOBX')
+    assert len(marked) == 6 * ROUNDS
+    assert marked['attendance_id'].nunique() == 6 * ROUNDS
+
+
+def test_writes_outside_the_locked_shards_are_refused(sharded_dir):
+    # A lock of every shard does not cover one made during the block: writing there is refused
+    # instead of taking its lock out of order
+    assert _run(sharded_dir, {}) == [ROUNDS] * 6
+    open_backend('sharded', sharded_dir)
+    assert storage.find_rows('attendance', job_id='JOBX').empty
+
+
+def test_nested_lock_must_be_covered(sharded_dir):
+    open_backend('sharded', sharded_dir)
+    storage.append_rows('jobs', [{'job_id': job_id, 'district': district, 'status': 'Active'}
+                                 for job_id, district in [('JOB0001', 'Banglore'), ('JOB0002', 'Mysore')]])
+    with storage.locked('allocations', job_id=['JOB0001', 'JOB0002']):
+        with storage.locked('allocations', job_id='JOB0001'):
+            pass
+    with storage.locked('allocations', job_id='JOB0001'):
+        with pytest.raises(RuntimeError):
+            with storage.locked('allocations', job_id='JOB0002'):
+                pass
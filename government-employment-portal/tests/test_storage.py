@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import pandas as pd
+import pytest
+import storage
+from storage import CSVBackend
+from conftest import BACKENDS, convert, open_backend
+
+
+def user(user_id, days_worked, **fields):
+    return {'user_id': user_id, 'name': user_id, 'email': f'{user_id.lower()}@example.com', 'phone': '9000000000',
+            'password': '', 'role': 'worker', 'district': 'Banglore', 'aadhaar': '', 'disability_status': 'No',
+            'days_worked': days_worked, 'created_at': '2026-01-01 10:00:00', **fields}
+
+
+def days_worked(backend, user_id):
+    rows = backend.find('users', user_id=user_id)
+    assert len(rows) == 1
+    return int(rows['days_worked'].iloc[0])
+
+
+def test_latest_version_wins_across_compaction(data_dir):
+    # Two backends on the same files stand for two processes, each with its own cached tables
+    first, second = CSVBackend(data_dir), CSVBackend(data_dir)
+    first.init()
+    first.append('users', [user('WOR0100', 0), user('WOR0101', 0)])
+    first.update('users', [user('WOR0100', 1)])
+    second.update('users', [user('WOR0100', 2)])
+    assert days_worked(first, 'WOR0100') == 2
+
+    # Several versions of a row in one batch, and in batches read back together
+    first.update('users', [user('WOR0100', 3), user('WOR0101', 5), user('WOR0100', 4)])
+    first.update('users', [user('WOR0101', 6)])
+    assert days_worked(first, 'WOR0100') == 4
+    assert days_worked(second, 'WOR0101') == 6
+    assert first.table('users').stale_rows() == 6
+
+    # The compacted file holds the latest versions only; both caches see them after the rewrite
+    second.compact()
+    assert first.table('users').stale_rows() == 0
+    first.update('users', [user('WOR0101', 7)])
+    for backend in (first, second, CSVBackend(data_dir)):
+        assert days_worked(backend, 'WOR0100') == 4
+        assert days_worked(backend, 'WOR0101') == 7
+        assert backend.read('users')['user_id'].is_unique
+
+
+def _take_ids(backend, data_dir, rounds, results):
+    open_backend(backend, data_dir)
+    taken = []
+    for _ in range(rounds):
+        ids = list(storage.next_ids('attendance', 3))
+        storage.append_rows('attendance', [{
+            'attendance_id': f'ATT{str(number).zfill(5)}', 'job_id': 'JOB0001', 'worker_id': 'WOR0001',
+            'supervisor_id': 'SUP0002', 'date': '2026-01-01', 'status': 'Present', 'marked_at': '2026-01-01 10:00:00',
+        } for number in ids])
+        taken.extend(ids)
+    results.put(taken)
+    storage.configure()
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_next_ids_are_unique_across_processes(backend, data_dir):
+    convert(backend, data_dir)
+    processes, rounds = 6, 40
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_take_ids, args=(backend, data_dir, rounds, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    taken = [number for _ in workers for number in results.get(timeout=120)]
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+
+    assert sorted(taken) == list(range(1, processes * rounds * 3 + 1))
+    open_backend(backend, data_dir)
+    ids = storage.read_table('attendance')['attendance_id']
+    assert len(ids) == len(taken) and ids.is_unique
+    storage.configure()
+
+
+def test_rewrite_keeps_the_file_mode(data_dir):
+    backend = CSVBackend(data_dir)
+    backend.init()
+    path = storage.table_path(data_dir, 'users')
+    os.chmod(path, 0o640)
+    backend.write('users', backend.read('users'))
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+
+def test_failed_rewrite_leaves_the_table_as_it_was(data_dir, monkeypatch):
+    backend = CSVBackend(data_dir)
+    backend.init()
+    path = storage.table_path(data_dir, 'users')
+    with open(path, 'rb') as f:
+        before = f.read()
+
+    def fail(df):
+        raise OSError('disk full')
+    monkeypatch.setattr(storage, 'format_rows', fail)
+    with pytest.raises(OSError):
+        backend.write('users', backend.read('users').iloc[:1])
+    monkeypatch.undo()
+
+    with open(path, 'rb') as f:
+        assert f.read() == before
+    assert not [entry for entry in os.listdir(data_dir) if entry.endswith('.tmp')]
+    assert len(CSVBackend(data_dir).read('users')) == len(backend.read('users'))
+
+
+def test_replace_rows_copies_read_only_columns():
+    # Columns mapped from a snapshot are read-only; replacing rows makes new arrays instead
+    schema = {'user_id': 'cat:user', 'days_worked': 'int'}
+    df = storage.coerce_types(pd.DataFrame({'user_id': ['WOR1', 'WOR2', 'WOR3'], 'days_worked': [1, 2, 3]}), schema)
+    days = df['days_worked'].to_numpy().copy()
+    days.flags.writeable = False
+    df = pd.DataFrame({'user_id': df['user_id'], 'days_worked': days}, copy=False)
+    rows = storage.coerce_types(pd.DataFrame({'user_id': ['WOR3'], 'days_worked': [9]}), schema)
+    storage.replace_rows(df, [2], rows, schema)
+    assert df['days_worked'].tolist() == [1, 2, 9]
+    assert days.tolist() == [1, 2, 3]
@@ -0,0 +1,70 @@
+import os
+import pytest
+import storage
+import waitlist
+from conftest import open_backend
+
+# Waiting workers in the order they were ranked, with their scores
+WAITING = [('WOR0011', 5), ('WOR0012', 9), ('WOR0013', 9), ('WOR0014', 3), ('WOR0015', 7), ('WOR0016', 1)]
+
+
+@pytest.fixture
+def job(backend):
+    storage.append_rows('jobs', [{'job_id': 'JOB0001', 'district': 'Banglore', 'workers_required': 2,
+                                  'daily_wage': 300.0, 'status': 'Active'}])
+    workers = [('WOR0001', 10, 'Allocated'), ('WOR0002', 10, 'Allocated')] + \
+        [(worker_id, score, 'Waiting') for worker_id, score in WAITING]
+    storage.append_rows('allocations', [{
+        'allocation_id': f'ALLOC{str(number).zfill(5)}', 'job_id': 'JOB0001', 'worker_id': worker_id,
+        'allocation_status': status, 'response': 'Pending', 'priority_score': score,
+        'allocated_at': '2026-01-01 10:00:00',
+    } for number, (worker_id, score, status) in enumerate(workers, 1)])
+    return backend
+
+
+def allocation(worker_id):
+    return storage.first_row(storage.find_rows('allocations', job_id='JOB0001', worker_id=worker_id))
+
+
+def restart():
+    # A new process: no cached tables and no waiting list in memory, only the files
+    waitlist._lists.clear()
+    open_backend(storage.get_backend().name, storage.get_backend().data_dir)
+
+
+def give_up(worker_id):
+    with storage.locked('allocations', job_id='JOB0001'):
+        promoted = waitlist.release(dict(allocation(worker_id), response='Rejected'))
+    return promoted and promoted['worker_id']
+
+
+def test_promotion_order_survives_restarts(job):
+    assert give_up('WOR0001') == 'WOR0012'
+    saved = waitlist.get_waitlist('JOB0001')
+    inode = os.stat(saved.path).st_ino
+    restart()
+    # Equal scores keep the order the workers were ranked in
+    assert give_up('WOR0012') == 'WOR0013'
+    restart()
+    # A worker who declined while waiting is skipped
+    storage.update_rows('allocations', [dict(allocation('WOR0015'), response='Declined')])
+    assert give_up('WOR0002') == 'WOR0011'
+    restart()
+    assert give_up('WOR0013') == 'WOR0014'
+
+    # The heap was loaded from its file each time, with the log of the IDs taken off it
+    current = waitlist.get_waitlist('JOB0001')
+    assert os.stat(current.path).st_ino == inode
+    with open(current.log_path) as f:
+        assert len(f.read().split()) == 5
+    statuses = storage.find_rows('allocations', job_id='JOB0001', allocation_status='Allocated')
+    assert sorted(statuses['worker_id'].astype(str)) == ['WOR0011', 'WOR0014']
+
+
+def test_processes_share_the_taken_entries(job):
+    assert give_up('WOR0001') == 'WOR0012'
+    # Another process's copy of the list, loaded before this one takes the next entry
+    other = waitlist.Waitlist(waitlist._directory(), 'JOB0001')
+    with storage.locked('allocations', job_id='JOB0001'):
+        assert other.pop()['worker_id'] == 'WOR0013'
+    assert give_up('WOR0002') == 'WOR0015'
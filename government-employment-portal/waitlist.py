@@ -0,0 +1,150 @@
+import heapq
+import json
+import os
+import threading
+from datetime import datetime
+import pandas as pd
+from storage import find_rows, update_rows, locked, get_backend, meta_path, first_row
+from counters import allocations_added, allocations_released
+
+# Per-job waiting lists kept as heaps, so a slot given up by an allocated worker goes to the
+# best waiting worker without re-reading and re-ranking the job's allocations. An entry is
+# (-priority_score, position, allocation_id): highest score first, then the order the
+# workers were ranked in. A job's heap is built from its Waiting rows the first time it is
+# needed and saved to .meta/waitlists/<job_id>.json; the allocation IDs taken off it since
+# are appended to <job_id>.log, so every process pops from the same list. Removing the files
+# (invalidate) makes the next use rebuild it. Everything here runs under the allocations lock.
+
+# Responses with which a worker gives up a job
+REJECTIONS = {'Rejected', 'Declined', 'Decline', 'Not Interested'}
+
+# The saved heap is rewritten without its taken entries once the log is longer than this
+# and longer than the heap
+COMPACT_MIN_TAKEN = 1000
+
+
+class Waitlist:
+    def __init__(self, directory, job_id):
+        self.path = os.path.join(directory, f'{job_id}.json')
+        self.log_path = os.path.join(directory, f'{job_id}.log')
+        self.job_id = job_id
+        self.heap = []
+        self.taken = set()
+        self._sig = None
+        self._offset = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def _refresh(self):
+        sig = self._stat()
+        if sig is None:
+            self._build()
+        elif sig != self._sig:
+            with open(self.path) as f:
+                self.heap = [tuple(entry) for entry in json.load(f)]
+            self.taken, self._offset, self._sig = set(), 0, sig
+        # IDs taken off the list by any process since the heap was saved
+        try:
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        data = data[:data.rfind(b'\n') + 1]
+        self.taken.update(data.decode().split())
+        self._offset += len(data)
+
+    def _build(self):
+        rows = find_rows('allocations', job_id=self.job_id, allocation_status='Waiting')
+        rows = rows[~rows['response'].isin(REJECTIONS)]
+        self.heap = list(zip((-rows['priority_score']).tolist(), range(len(rows)), rows['allocation_id'].tolist()))
+        heapq.heapify(self.heap)
+        self._save()
+
+    def _save(self):
+        self.heap = [entry for entry in self.heap if entry[2] not in self.taken]
+        heapq.heapify(self.heap)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self.heap, f)
+        os.replace(f'{self.path}.tmp', self.path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.taken, self._offset, self._sig = set(), 0, self._stat()
+
+    def _take(self, allocation_id):
+        with open(self.log_path, 'a') as f:
+            f.write(f'{allocation_id}\n')
+        self.taken.add(allocation_id)
+
+    def pop(self):
+        # The current row of the best worker still waiting, taken off the list, or None
+        self._refresh()
+        while self.heap:
+            allocation_id = heapq.heappop(self.heap)[2]
+            if allocation_id in self.taken:
+                continue
+            self._take(allocation_id)
+            # The row is checked, and read in full for the update, in case it changed since
+            # the heap was built (e.g. the worker declined while waiting)
+            rows = find_rows('allocations', job_id=self.job_id, allocation_id=allocation_id)
+            if not rows.empty:
+                row = first_row(rows)
+                if row['allocation_status'] == 'Waiting' and row['response'] not in REJECTIONS:
+                    if len(self.taken) > max(COMPACT_MIN_TAKEN, len(self.heap)):
+                        self._save()
+                    return row
+        return None
+
+
+_lists = {}
+_lists_lock = threading.Lock()
+
+
+def _directory():
+    path = meta_path(get_backend().data_dir, 'waitlists')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_waitlist(job_id):
+    key = (_directory(), job_id)
+    with _lists_lock:
+        if key not in _lists:
+            _lists[key] = Waitlist(*key)
+        return _lists[key]
+
+
+def invalidate(job_ids):
+    # Call after adding Waiting rows to these jobs other than through this module
+    job_ids = list(job_ids)
+    with locked('allocations', job_id=job_ids):
+        for job_id in job_ids:
+            waitlist = get_waitlist(job_id)
+            for path in (waitlist.path, waitlist.log_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def release(row):
+    # row is the allocation of a worker who gave up the job, with their response. If it held
+    # a slot, the slot goes to the best waiting worker: both rows are saved in one write.
+    # Returns the promoted row, or None
+    with locked('allocations', job_id=row['job_id']):
+        if row['allocation_status'] != 'Allocated':
+            update_rows('allocations', [row])
+            return None
+        released = dict(row, allocation_status='Released')
+        promoted = get_waitlist(row['job_id']).pop()
+        if promoted is not None:
+            promoted = dict(promoted, allocation_status='Allocated',
+                            allocated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        update_rows('allocations', [released] + ([promoted] if promoted else []))
+        allocations_released(pd.DataFrame([released]))
+        if promoted:
+            allocations_added(pd.DataFrame([promoted]))
+    return promoted